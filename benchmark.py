@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import typing
+import zlib
+
+import mitigate
+
+
+def make_message(rng: random.Random, ipc_subtype: int, payload: bytes, is_self: bool = True) -> bytes:
+    ipc = mitigate.XivMessageIpc.DEFINITION.pack(mitigate.XivMessageIpc.TYPE_INTERESTED, ipc_subtype, b"\0\0", 1,
+                                                 int(time.time()), b"\0" * 4) + payload
+    source_actor = rng.randrange(0x10000000, 0x20000000)
+    target_actor = source_actor if is_self else rng.randrange(0x10000000, 0x20000000)
+    return mitigate.XivMessage.DEFINITION.pack(mitigate.XivMessage.DEFINITION.size + len(ipc), source_actor,
+                                               target_actor, mitigate.XivMessage.SEGMENT_TYPE_IPC, b"\0\0") + ipc
+
+
+def make_bundle(messages: typing.List[bytes], compressed: bool) -> bytes:
+    data = b"".join(messages)
+    if compressed:
+        data = zlib.compress(data)
+    return mitigate.XivBundle.DEFINITION.pack(mitigate.XivBundle.MAGIC_CONSTANT_1, int(time.time() * 1000),
+                                              mitigate.XivBundle.DEFINITION.size + len(data), b"\0\0", 1,
+                                              len(messages), 1, int(compressed), b"\0" * 6) + data
+
+
+def make_stream(rng: random.Random, count: int, compressed_ratio: float) -> bytes:
+    return b"".join(make_bundle([make_message(rng, rng.randrange(0x10000), rng.randbytes(rng.randrange(16, 512)))
+                                 for _ in range(rng.randint(1, 8))],
+                                rng.random() < compressed_ratio)
+                    for _ in range(count))
+
+
+def corrupt(rng: random.Random, data: bytes, ratio: float) -> bytes:
+    """Inserts garbage between bundles, including runs of zeroes and stray copies of the magic."""
+    res = []
+    for item in mitigate.XivBundle.find(bytearray(data), received_at=time.time()):
+        res.append(bytes(item) if type(item) is memoryview else bytes(item.to_wire()))
+        if rng.random() < ratio:
+            garbage = bytearray(rng.randbytes(rng.randrange(1, 4096)))
+            position = rng.randrange(len(garbage))
+            magic = rng.choice((mitigate.XivBundle.MAGIC_CONSTANT_1, mitigate.XivBundle.MAGIC_CONSTANT_2))
+            garbage[position:position] = magic + rng.randbytes(rng.randrange(0, 64))
+            res.append(bytes(garbage))
+    return b"".join(res)
+
+
+class TrafficGenerator:
+    """Builds bundles resembling game traffic, using the opcodes of the given region."""
+
+    def __init__(self, rng: random.Random, profile: mitigate.RegionProfile, compressed_ratio: float):
+        self.rng = rng
+        self.profile = profile
+        self.compressed_ratio = compressed_ratio
+
+    def _unrelated(self) -> bytes:
+        return make_message(self.rng, self.rng.randrange(0x10000), self.rng.randbytes(self.rng.randrange(16, 512)),
+                            self.rng.random() < 0.5)
+
+    def _bundle(self, messages: typing.List[bytes]) -> bytes:
+        return make_bundle(messages, self.rng.random() < self.compressed_ratio)
+
+    def action_request(self) -> bytes:
+        payload = struct.pack("<IIQ", 0, self.rng.randrange(1, 0x8000), self.rng.randrange(1 << 32)) + bytes(16)
+        return make_message(self.rng, self.profile.request_action, payload)
+
+    def action_effect(self) -> bytes:
+        effect_count = self.rng.randint(1, 8)
+        payload = mitigate.XivMessageIpcActionEffect.DEFINITION.pack(
+            self.rng.randrange(1 << 32), b"\0" * 4, self.rng.randrange(1, 0x8000), self.rng.randrange(1 << 32), 0.6, 0,
+            0, self.rng.randrange(0x10000), self.rng.randrange(0x10000), 0, 1, b"\0", effect_count, b"\0\0")
+        payload += self.rng.randbytes(64 * effect_count)
+        return make_message(self.rng, self.rng.choice(self.profile.response_action_result), payload)
+
+    def actor_control(self) -> bytes:
+        category = mitigate.XivMessageIpcActorControl.CATEGORY_CANCEL_CAST if self.rng.random() < 0.1 else \
+            self.rng.randrange(0x100)
+        payload = mitigate.XivMessageIpcActorControl.DEFINITION.pack(category, b"\0\0", 0, 0,
+                                                                     self.rng.randrange(0x8000), 0, b"\0" * 4)
+        return make_message(self.rng, self.profile.response_actor_control, payload)
+
+    def actor_control_self(self) -> bytes:
+        category = mitigate.XivMessageIpcActorControlSelf.CATEGORY_ROLLBACK if self.rng.random() < 0.1 else \
+            self.rng.randrange(0x100)
+        payload = mitigate.XivMessageIpcActorControlSelf.DEFINITION.pack(category, b"\0\0", 0, 0,
+                                                                         self.rng.randrange(0x8000), 0, 0, 0, b"\0" * 4)
+        return make_message(self.rng, self.profile.response_actor_control_self, payload)
+
+    def actor_cast(self) -> bytes:
+        action_id = self.rng.randrange(1, 0x8000)
+        payload = mitigate.XivMessageIpcActorCast.DEFINITION.pack(action_id, 1, b"\0", action_id, b"\0\0", 2.5,
+                                                                  self.rng.randrange(1 << 32), 0., b"\0" * 4, 0, 0, 0,
+                                                                  b"\0\0")
+        return make_message(self.rng, self.profile.response_actor_cast, payload)
+
+    def client_bundle(self) -> bytes:
+        return self._bundle([self.action_request() if self.rng.random() < 0.3 else self._unrelated()
+                             for _ in range(self.rng.randint(1, 4))])
+
+    def server_bundle(self) -> bytes:
+        messages = []
+        for _ in range(self.rng.randint(1, 8)):
+            roll = self.rng.random()
+            if roll < 0.1:
+                messages.append(self.action_effect())
+            elif roll < 0.2:
+                messages.append(self.actor_control())
+            elif roll < 0.25:
+                messages.append(self.actor_control_self())
+            elif roll < 0.3:
+                messages.append(self.actor_cast())
+            else:
+                messages.append(self._unrelated())
+        return self._bundle(messages)
+
+
+def recv_bundles(sock: socket.socket, count: int, on_bundle: typing.Optional[typing.Callable[[], None]] = None) -> int:
+    """Reads until count bundles have been received, and returns the number of bytes read."""
+    framer = mitigate.XivBundleFramer()
+    received = 0
+    while count > 0:
+        length = sock.recv_into(framer.writable())
+        if not length:
+            raise ConnectionError("Connection closed before receiving every bundle")
+        framer.commit(length, time.time())
+        received += length
+        for item in framer:
+            if type(item) is not memoryview:
+                count -= 1
+                if on_bundle is not None:
+                    on_bundle()
+    return received
+
+
+class StubServer:
+    """Stand-in for a game server on loopback. Every accepted connection is handled by handler in its own thread."""
+
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(8)
+        self.address = self.listener.getsockname()
+        self.handler: typing.Optional[typing.Callable[[socket.socket], None]] = None
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            sock, _ = self.listener.accept()
+            threading.Thread(target=self._handle, args=(sock,), daemon=True).start()
+
+    def _handle(self, sock: socket.socket):
+        with sock:
+            self.handler(sock)
+
+
+class ProxyProcess:
+    """Runs a Connection for exactly one client in a child process, so that its CPU time can be measured alone."""
+
+    def __init__(self, engine: str, destination: typing.Tuple[str, int], region: str):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.address = self.listener.getsockname()
+        self.cpu_seconds = 0.
+
+        sys.stdout.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                mitigate.log_writer = mitigate.LogWriter(level=mitigate.LOG_ERROR, rate=0)
+                sock, source = self.listener.accept()
+                connection = mitigate.Connection(sock, source, destination, region)
+                mitigate.Connection.all_connections.append(connection)
+                if engine == "asyncio":
+                    asyncio.run(connection.run_async())
+                else:
+                    connection.run()
+            finally:
+                os._exit(0)
+        self.listener.close()
+
+    def wait(self):
+        _, _, rusage = os.wait4(self.pid, 0)
+        self.cpu_seconds = rusage.ru_utime + rusage.ru_stime
+
+
+def measure_latency(stub: StubServer, address: typing.Tuple[str, int], requests: typing.List[bytes],
+                    responses: typing.List[bytes]) -> mitigate.LatencyHistogram:
+    """Sends requests one by one, each answered by the stub with a response; returns round trip times."""
+
+    def handler(sock: socket.socket):
+        it = iter(responses)
+        try:
+            recv_bundles(sock, len(requests), lambda: sock.sendall(next(it)))
+        except ConnectionError:
+            pass
+
+    stub.handler = handler
+    histogram = mitigate.LatencyHistogram()
+    with socket.create_connection(address) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        for request in requests:
+            started_at = time.perf_counter_ns()
+            sock.sendall(request)
+            recv_bundles(sock, 1)
+            histogram.record(time.perf_counter_ns() - started_at)
+    return histogram
+
+
+def measure_throughput(stub: StubServer, address: typing.Tuple[str, int], client_bundles: typing.List[bytes],
+                       server_bundles: typing.List[bytes]) -> float:
+    """Streams both lists of bundles in both directions at the same time; returns the elapsed seconds."""
+    client_data = b"".join(client_bundles)
+    server_data = b"".join(server_bundles)
+    done = threading.Event()
+
+    def handler(sock: socket.socket):
+        sender = threading.Thread(target=sock.sendall, args=(server_data,))
+        sender.start()
+        recv_bundles(sock, len(client_bundles))
+        sender.join()
+        done.set()
+
+    stub.handler = handler
+    with socket.create_connection(address) as sock:
+        started_at = time.perf_counter()
+        sender = threading.Thread(target=sock.sendall, args=(client_data,))
+        sender.start()
+        recv_bundles(sock, len(server_bundles))
+        sender.join()
+        done.wait()
+        return time.perf_counter() - started_at
+
+
+def bench_relay(engine: str, compressed_ratio: float, args: argparse.Namespace,
+                stub: StubServer) -> typing.Dict[str, float]:
+    rng = random.Random(args.seed)
+
+    generator = TrafficGenerator(rng, mitigate.REGION_PROFILES[args.region], compressed_ratio)
+    requests = [make_bundle([generator.action_request()], False) for _ in range(args.round_trips)]
+    responses = [make_bundle([generator.action_effect()], False) for _ in range(args.round_trips)]
+    client_bundles = [generator.client_bundle() for _ in range(args.bundles)]
+    server_bundles = [generator.server_bundle() for _ in range(args.bundles)]
+    total_bytes = sum(len(x) for x in client_bundles) + sum(len(x) for x in server_bundles)
+
+    direct = measure_latency(stub, stub.address, requests, responses)
+
+    proxy = ProxyProcess(engine, stub.address, args.region)
+    proxied = measure_latency(stub, proxy.address, requests, responses)
+    proxy.wait()
+
+    proxy = ProxyProcess(engine, stub.address, args.region)
+    elapsed = measure_throughput(stub, proxy.address, client_bundles, server_bundles)
+    proxy.wait()
+
+    return {
+        "bundles_per_second": (len(client_bundles) + len(server_bundles)) / elapsed,
+        "mb_per_second": total_bytes / elapsed / 1048576,
+        "added_p50_ms": (proxied.percentile(50) - direct.percentile(50)) / 1e6,
+        "added_p99_ms": (proxied.percentile(99) - direct.percentile(99)) / 1e6,
+        "cpu_ns_per_byte": proxy.cpu_seconds * 1e9 / total_bytes,
+    }
+
+
+def bench_find(name: str, data: bytes, seconds: float) -> typing.Dict[str, float]:
+    buffer = bytearray(data)
+    bundles = discarded = iterations = 0
+    started = time.perf_counter()
+    elapsed = 0.
+    while elapsed < seconds:
+        for item in mitigate.XivBundle.find(buffer, received_at=time.time()):
+            if type(item) is memoryview:
+                discarded += 1
+            else:
+                bundles += 1
+        iterations += 1
+        elapsed = time.perf_counter() - started
+    print(f"find[{name}]: {len(data) * iterations / elapsed / 1048576:.2f} MB/s, "
+          f"{bundles / elapsed:.0f} bundles/s, {discarded // iterations} discarded fragments")
+    return {
+        "bundles_per_second": bundles / elapsed,
+        "mb_per_second": len(data) * iterations / elapsed / 1048576,
+    }
+
+
+def bench_replay(path: str, seconds: float) -> typing.Dict[str, float]:
+    session = mitigate.SessionReplay(path)
+    try:
+        processed = iterations = 0
+        started = time.perf_counter()
+        elapsed = 0.
+        while elapsed < seconds:
+            connection = mitigate.Connection(None, None, session.destination, session.region)
+            processed += session.replay(connection)
+            iterations += 1
+            elapsed = time.perf_counter() - started
+    finally:
+        session.close()
+    bundles = sum(x.bundles for x in connection.stats.directions.values()) * iterations
+    print(f"replay[{os.path.basename(path)}]: {processed / elapsed / 1048576:.2f} MB/s, "
+          f"{bundles / elapsed:.0f} bundles/s")
+    return {
+        "bundles_per_second": bundles / elapsed,
+        "mb_per_second": processed / elapsed / 1048576,
+    }
+
+
+def check_regressions(results: typing.Dict[str, typing.Dict[str, float]],
+                      baseline: typing.Dict[str, typing.Dict[str, float]], tolerance: float) -> typing.List[str]:
+    """Returns descriptions of every throughput or CPU cost that got worse than baseline by more than tolerance."""
+    res = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for key in ("bundles_per_second", "mb_per_second"):
+            if key in metrics and key in baseline[name] and metrics[key] < baseline[name][key] * (1 - tolerance):
+                res.append(f"{name}.{key}: {metrics[key]:.2f} < {baseline[name][key]:.2f}")
+        key = "cpu_ns_per_byte"
+        if key in metrics and key in baseline[name] and metrics[key] > baseline[name][key] * (1 + tolerance):
+            res.append(f"{name}.{key}: {metrics[key]:.2f} > {baseline[name][key]:.2f}")
+    return res
+
+
+def __main__() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark parts of mitigate.py with synthetic traffic.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bundles", type=int, default=20000, help="number of bundles to send in each direction")
+    parser.add_argument("--round-trips", type=int, default=2000, help="number of round trips to measure latency")
+    parser.add_argument("--seconds", type=float, default=2., help="minimum duration of each find measurement")
+    parser.add_argument("--region", default="INTL", help="region whose opcodes to use")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), action="append",
+                        help="relay engine to benchmark; can be specified multiple times (default: both)")
+    parser.add_argument("--capture", action="append", default=[],
+                        help="also benchmark replaying a file recorded with --capture-dir; "
+                             "can be specified multiple times")
+    parser.add_argument("--output", help="write results to this file as JSON")
+    parser.add_argument("--baseline", help="compare against results previously written using --output")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="fraction by which a result may be worse than baseline before failing")
+    args = parser.parse_args()
+
+    mitigate.log_writer = mitigate.LogWriter(level=mitigate.LOG_ERROR, rate=0)
+    results = {}
+    rng = random.Random(args.seed)
+    clean = make_stream(rng, 2000, 0.5)
+    results["find.clean"] = bench_find("clean", clean, args.seconds)
+    results["find.corrupted"] = bench_find("corrupted", corrupt(rng, clean, 0.2), args.seconds)
+    results["find.garbage"] = bench_find("garbage", rng.randbytes(len(clean)), args.seconds)
+    results["find.zeroes"] = bench_find("zeroes", bytes(len(clean)), args.seconds)
+
+    for path in args.capture:
+        results[f"replay.{os.path.basename(path)}"] = bench_replay(path, args.seconds)
+
+    stub = StubServer()
+    for engine in args.engine or ("thread", "asyncio"):
+        for name, compressed_ratio in (("uncompressed", 0.), ("compressed", 1.)):
+            result = bench_relay(engine, compressed_ratio, args, stub)
+            results[f"relay.{engine}.{name}"] = result
+            print(f"relay[{engine}, {name}]: {result['bundles_per_second']:.0f} bundles/s, "
+                  f"{result['mb_per_second']:.2f} MB/s, "
+                  f"added p50={result['added_p50_ms']:.3f}ms p99={result['added_p99_ms']:.3f}ms, "
+                  f"{result['cpu_ns_per_byte']:.1f} CPU ns/byte")
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            regressions = check_regressions(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(__main__())
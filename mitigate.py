@@ -1,19 +1,43 @@
 #!/usr/bin/sudo python
 
+import argparse
+import array
+import asyncio
+import bisect
 import collections
+import cProfile
 import datetime
+import errno
+import functools
+import http.server
+import io
 import ipaddress
+import itertools
+import json
+import marshal
+import math
+import mmap
+import operator
 import os
+import pstats
+import queue
 import random
+import re
+import select
+import signal
 import socket
 import struct
+import sys
 import threading
 import time
+import traceback
 import typing
+import urllib.parse
 import zlib
 
 ACTION_ID_AUTO_ATTACK = 0x0007
 SO_ORIGINAL_DST = 80
+SO_TIMESTAMPNS = 35
 
 # Server responses have been usually taking between 50ms and 100ms on below-1ms
 # latency to server, so 75ms is a good average.
@@ -23,16 +47,92 @@ SO_ORIGINAL_DST = 80
 # Feel free to increase and see how does it feel like to play on high latency instead, though.
 EXTRA_DELAY = 0.075
 
-# Based on assumption that all game servers of a datacenter should exist in /24 subnet
-INTL_DATACENTER_IP_NETWORK = [socket.gethostbyname(f"neolobby{i:>02}.ffxiv.com") for i in range(1, 9)]
-INTL_DATACENTER_IP_NETWORK = set(ipaddress.ip_network(".".join(x.split(".")[0:3]) + ".0/24")
-                                 for x in INTL_DATACENTER_IP_NETWORK)
 
-KR_DATACENTER_IP_NETWORK = [socket.gethostbyname("lobbyf-live.ff14.co.kr")]
-KR_DATACENTER_IP_NETWORK = set(ipaddress.ip_network(".".join(x.split(".")[0:3]) + ".0/24")
-                               for x in KR_DATACENTER_IP_NETWORK)
-
-multithread_print_lock = threading.Lock()
+class RegionProfile(typing.NamedTuple):
+    """Where servers of a region are, and the opcodes they use. Adding a region only takes adding a profile."""
+
+    name: str
+    # Based on assumption that all game servers of a datacenter should exist in /24 subnet of a lobby server
+    lobby_hostnames: typing.Tuple[str, ...]
+    request_action: int
+    response_actor_cast: int
+    response_actor_control: int
+    response_actor_control_self: int
+    response_action_result: typing.Tuple[int, ...]
+    # Bundle conn_type that never carries any of the above, such as chat. Checked for each bundle, so that compressed
+    # ones are forwarded without being inflated.
+    conn_types_without_ipc: typing.Tuple[int, ...] = ()
+
+
+# See: https://github.com/ravahn/machina/tree/NetworkStructs/Machina.FFXIV/Headers/Opcodes
+REGION_PROFILES = {x.name: x for x in (
+    RegionProfile(
+        name="INTL",
+        lobby_hostnames=tuple(f"neolobby{i:>02}.ffxiv.com" for i in range(1, 9)),
+        request_action=0x017a,
+        response_actor_cast=0x02b2,
+        response_actor_control=0x00f0,
+        response_actor_control_self=0x017a,
+        response_action_result=(0x021f, 0x03df, 0x00ad, 0x0229, 0x0197),
+        conn_types_without_ipc=(2,),
+    ),
+    RegionProfile(
+        name="KR",
+        lobby_hostnames=("lobbyf-live.ff14.co.kr",),
+        request_action=0x00f0,
+        response_actor_cast=0x03b8,
+        response_actor_control=0x013d,
+        response_actor_control_self=0x025f,
+        response_action_result=(0x0266, 0x0167, 0x03a7, 0x016b, 0x0231),
+        conn_types_without_ipc=(2,),
+    ),
+)}
+
+DATACENTER_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "mitigate", "datacenters.json")
+DATACENTER_CACHE_TTL = 86400
+DATACENTER_RESOLVE_TIMEOUT = 10
+
+PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mitigate", "profiles")
+
+
+class DatacenterIndex:
+    """Finds the region an IPv4 address belongs to, with one dict lookup per distinct prefix length."""
+
+    def __init__(self, networks: typing.Dict[str, typing.Set[ipaddress.IPv4Network]]):
+        self.networks = {region: frozenset(x) for region, x in networks.items()}
+        by_prefix = collections.defaultdict(dict)
+        for region, region_networks in self.networks.items():
+            for network in region_networks:
+                by_prefix[network.prefixlen][int(network.network_address) >> (32 - network.prefixlen)] = region
+        # Longest prefix first, so that more specific networks win.
+        self.prefixes = tuple((32 - prefixlen, by_prefix[prefixlen]) for prefixlen in sorted(by_prefix, reverse=True))
+
+    def __bool__(self):
+        return any(self.networks.values())
+
+    def lookup(self, address: str) -> typing.Optional[str]:
+        value = int.from_bytes(socket.inet_aton(address), "big")
+        for shift, regions in self.prefixes:
+            region = regions.get(value >> shift)
+            if region is not None:
+                return region
+        return None
+
+    def all_networks(self) -> typing.List[ipaddress.IPv4Network]:
+        return sorted(set().union(*self.networks.values()))
+
+
+# Replaced by DatacenterResolver.
+DATACENTER_INDEX = DatacenterIndex({})
+
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_LEVEL_NAMES = {LOG_DEBUG: "debug", LOG_INFO: "info", LOG_WARNING: "warning", LOG_ERROR: "error"}
+
+# Only this many bytes of discarded data make it into the log.
+LOG_DISCARDED_BYTES = 256
 
 
 class IncompleteDataException(ValueError):
@@ -43,35 +143,672 @@ class InvalidDataException(ValueError):
     pass
 
 
+class TokenBucket:
+    """Allows up to burst events at once, refilled at rate events per second."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.denied = 0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            self.denied += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LogWriter:
+    """Formats and writes log records from a background thread, so that relaying never waits on the terminal.
+
+    Records are printed if they are at or above level, and every record goes to the file sink, if any, as a line of
+    JSON regardless of level or rate limiting."""
+
+    def __init__(self, level: int = LOG_INFO, file_path: typing.Optional[str] = None, rate: float = 50.,
+                 burst: float = 200., queue_size: int = 65536):
+        self.level = level
+        self.rate = rate
+        self.burst = burst
+        self.file = open(file_path, "a") if file_path else None
+        self.queue = queue.Queue(queue_size)
+        # Records that did not fit in the queue, and records that could not be printed or written.
+        self.dropped = 0
+        self.failed = 0
+        self.thread: typing.Optional[threading.Thread] = None
+        # Guards starting and stopping the thread, so that concurrent first records cannot start two of them.
+        self.thread_lock = threading.Lock()
+
+    def create_rate_limiter(self) -> typing.Optional[TokenBucket]:
+        return TokenBucket(self.rate, self.burst) if self.rate > 0 else None
+
+    def put(self, printed: bool, level: int, conn_id: int, event: str, fmt: str, fields: typing.Dict[str, typing.Any]):
+        if self.thread is None:
+            with self.thread_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put_nowait((time.time(), printed, level, conn_id, event, fmt, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        """Writes out every queued record and stops the background thread, until the next record is put."""
+        with self.thread_lock:
+            self.stop_thread()
+
+    def stop_thread(self):
+        """Does what drain does, with thread_lock already held; the thread cannot start again until it is released."""
+        if self.thread is not None:
+            # The thread keeps taking records off the queue for as long as it lives, so a full queue only waits.
+            while self.thread.is_alive():
+                try:
+                    self.queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            self.thread.join()
+            self.thread = None
+        # The thread only flushes once the queue is empty, and the sentinel was still queued behind the last record.
+        if self.file is not None:
+            try:
+                self.file.flush()
+            except OSError as e:
+                self.failed += 1
+                self._close_file(e)
+
+    def forget_file(self):
+        """Stops writing to the file without closing it, such as in a forked child that opens a LogWriter of its own.
+
+        Whatever was buffered was flushed by stop_thread before forking, so nothing gets written again when the file
+        object is collected."""
+        self.file = None
+
+    def close(self):
+        self.drain()
+        if self.file is not None:
+            self._close_file()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            timestamp, printed, level, conn_id, event, fmt, fields = record
+            if printed:
+                try:
+                    text = {k: v.hex(" ") if type(v) is bytes else v for k, v in fields.items()}
+                    print(f"[{conn_id}]", datetime.datetime.fromtimestamp(timestamp), fmt.format(**text))
+                except Exception:
+                    self.failed += 1
+            if self.file is not None:
+                try:
+                    self.file.write(json.dumps(dict(time=timestamp, level=LOG_LEVEL_NAMES.get(level, level),
+                                                    conn=conn_id, event=event, **fields),
+                                               default=self._to_json) + "\n")
+                    if self.queue.empty():
+                        self.file.flush()
+                except OSError as e:
+                    self.failed += 1
+                    self._close_file(e)
+                except Exception:
+                    self.failed += 1
+
+    def _close_file(self, error: typing.Optional[OSError] = None):
+        file, self.file = self.file, None
+        try:
+            file.close()
+        except OSError as e:
+            error = error or e
+        if error is not None:
+            try:
+                print("Stopped writing the log file:", error)
+            except Exception:
+                pass
+
+    @staticmethod
+    def _to_json(value: typing.Any):
+        if type(value) is bytes:
+            return value.hex()
+        return str(value)
+
+
+log_writer = LogWriter()
+
+
+def log_process_event(level: int, event: str, fmt: str, **fields):
+    """Logs an event that does not belong to any connection, through whichever log_writer is current."""
+    log_writer.put(level >= log_writer.level, level, 0, event, fmt, fields)
+
+
+class SignalDispatcher:
+    """Runs what is registered for a signal on a background thread, instead of in the signal handler.
+
+    A handler runs on the main thread in between whatever it was doing, possibly while it holds a lock that the handler
+    would then wait for forever. So the handler only writes the signal number to a pipe, which takes no lock."""
+
+    def __init__(self):
+        self.actions: typing.Dict[int, typing.Callable[[], None]] = {}
+        self.read_fd: typing.Optional[int] = None
+        self.write_fd: typing.Optional[int] = None
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def register(self, signum: int, action: typing.Callable[[], None]):
+        if self.write_fd is None:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.write_fd, False)
+            threading.Thread(target=self._run, args=(self.read_fd,), daemon=True).start()
+        self.actions[signum] = action
+        signal.signal(signum, self._handle)
+
+    def _handle(self, signum: int, frame):
+        if self.write_fd is None:
+            return
+        try:
+            os.write(self.write_fd, bytes((signum,)))
+        except BlockingIOError:
+            # Plenty of signals are waiting to be handled already.
+            pass
+
+    def _run(self, read_fd: int):
+        while True:
+            for signum in os.read(read_fd, 256):
+                action = self.actions.get(signum)
+                if action is None:
+                    continue
+                try:
+                    action()
+                except Exception:
+                    traceback.print_exc()
+
+    def _reset(self):
+        # The thread reading the pipe is not forked, and signals of the child should not reach the parent.
+        if self.write_fd is not None:
+            os.close(self.read_fd)
+            os.close(self.write_fd)
+        self.read_fd = self.write_fd = None
+        self.actions = {}
+
+
+signal_dispatcher = SignalDispatcher()
+
+
+class DatacenterResolver:
+    """Finds networks of game servers of each region by resolving lobby hostnames concurrently.
+
+    Results are saved to a cache file. A cache younger than ttl is used as-is, and an older one is used while being
+    refreshed in background. Regions listed in the config file, a JSON object of region to list of networks, are
+    never resolved."""
+
+    def __init__(self, cache_path: typing.Optional[str] = DATACENTER_CACHE_PATH, ttl: float = DATACENTER_CACHE_TTL,
+                 config_path: typing.Optional[str] = None):
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.overrides = self.load_config(config_path) if config_path else {}
+        self.regions = [x for x in REGION_PROFILES if x not in self.overrides]
+        self.on_change: typing.Optional[typing.Callable[[], None]] = None
+        self.stale: typing.Optional[typing.Dict[str, typing.Set[ipaddress.IPv4Network]]] = None
+        self.applied = False
+
+    @staticmethod
+    def load_config(path: str) -> typing.Dict[str, typing.Set[ipaddress.IPv4Network]]:
+        with open(path) as fp:
+            config = json.load(fp)
+        if not isinstance(config, dict) or any(x not in REGION_PROFILES for x in config):
+            raise ValueError(f"expected an object with keys from {', '.join(REGION_PROFILES)}")
+        return {region: set(ipaddress.ip_network(x, strict=False) for x in networks)
+                for region, networks in config.items()}
+
+    def load_cache(self) -> typing.Tuple[float, typing.Dict[str, typing.Set[ipaddress.IPv4Network]]]:
+        if self.cache_path is None:
+            return 0., {}
+        try:
+            with open(self.cache_path) as fp:
+                cache = json.load(fp)
+            return cache["resolved_at"], {region: set(ipaddress.ip_network(x) for x in networks)
+                                          for region, networks in cache["networks"].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return 0., {}
+
+    def save_cache(self, networks: typing.Dict[str, typing.Set[ipaddress.IPv4Network]]):
+        if self.cache_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            with open(self.cache_path + ".tmp", "w") as fp:
+                json.dump(dict(resolved_at=time.time(), networks={
+                    region: sorted(str(x) for x in networks[region]) for region in networks}), fp, indent=2)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        except OSError as e:
+            log_process_event(LOG_WARNING, "datacenter_cache_failed", "Failed to save {path}: {error}",
+                              path=self.cache_path, error=str(e))
+
+    def resolve(self) -> typing.Dict[str, typing.Set[ipaddress.IPv4Network]]:
+        """Looks up every hostname at once, and returns networks of those that resolved in time."""
+        res = {region: set() for region in self.regions}
+        # Lookups still running past the deadline keep adding to res while it is being copied.
+        lock = threading.Lock()
+
+        def lookup(region: str, hostname: str):
+            try:
+                address = socket.gethostbyname(hostname)
+            except OSError as e:
+                log_process_event(LOG_WARNING, "resolve_failed", "Failed to resolve {hostname}: {error}",
+                                  hostname=hostname, error=str(e))
+                return
+            network = ipaddress.ip_network(".".join(address.split(".")[0:3]) + ".0/24")
+            with lock:
+                res[region].add(network)
+
+        threads = [threading.Thread(target=lookup, args=(region, hostname), daemon=True)
+                   for region in self.regions for hostname in REGION_PROFILES[region].lobby_hostnames]
+        for x in threads:
+            x.start()
+        deadline = time.monotonic() + DATACENTER_RESOLVE_TIMEOUT
+        for x in threads:
+            x.join(max(0., deadline - time.monotonic()))
+        with lock:
+            return {region: set(networks) for region, networks in res.items()}
+
+    def start(self, background: bool = True):
+        """Makes networks available, waiting for resolution only if nothing is cached.
+
+        Cache older than ttl, or missing a region, is used while being refreshed in background. Without background,
+        such refresh is left for refresh_in_background to start."""
+        resolved_at, cached = self.load_cache()
+        self.stale = None
+        if not self.regions:
+            self.apply({})
+        elif any(cached.get(x) for x in self.regions):
+            self.apply(cached)
+            if time.time() - resolved_at >= self.ttl or not all(cached.get(x) for x in self.regions):
+                self.stale = cached
+                if background:
+                    self.refresh_in_background()
+        else:
+            self.refresh(cached)
+
+    def refresh_in_background(self):
+        if self.stale is not None:
+            threading.Thread(target=self.refresh, args=(self.stale,), daemon=True).start()
+            self.stale = None
+
+    def reload(self):
+        """Applies networks saved to the cache, such as by a refresh in another process."""
+        _, cached = self.load_cache()
+        if any(cached.get(x) for x in self.regions):
+            self.apply(cached)
+
+    def refresh(self, previous: typing.Dict[str, typing.Set[ipaddress.IPv4Network]]):
+        networks = self.resolve()
+        if any(networks.values()):
+            for region, x in networks.items():
+                if not x and previous.get(region):
+                    networks[region] = previous[region]
+            self.save_cache(networks)
+        else:
+            networks = previous
+        if self.applied and all(networks.get(x, set()) == previous.get(x, set()) for x in self.regions):
+            return
+        self.apply(networks)
+        log_process_event(LOG_INFO, "datacenters_changed", "Datacenter networks: {networks}",
+                          networks=", ".join(str(x) for x in DATACENTER_INDEX.all_networks()))
+        if self.on_change is not None:
+            self.on_change()
+
+    def apply(self, networks: typing.Dict[str, typing.Set[ipaddress.IPv4Network]]):
+        global DATACENTER_INDEX
+        DATACENTER_INDEX = DatacenterIndex({**networks, **self.overrides})
+        self.applied = True
+
+
+class LatencyHistogram:
+    """Fixed-size histogram of durations in nanoseconds, with buckets about 6% wide at any magnitude."""
+
+    SUB_BUCKET_BITS: typing.ClassVar[int] = 5
+    MAX_VALUE: typing.ClassVar[int] = 1 << 40  # about 18 minutes
+
+    _HALF: typing.ClassVar[int] = 1 << (SUB_BUCKET_BITS - 1)
+    _upper_bounds_cache: typing.ClassVar[typing.Optional[typing.List[int]]] = None
+
+    def __init__(self):
+        self.counts = [0] * (self._index(self.__class__.MAX_VALUE) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, value: int) -> int:
+        shift = max(0, value.bit_length() - cls.SUB_BUCKET_BITS)
+        return shift * cls._HALF + (value >> shift)
+
+    @classmethod
+    def _lower_bound(cls, index: int) -> int:
+        shift = max(0, index // cls._HALF - 1)
+        return (index - shift * cls._HALF) << shift
+
+    @classmethod
+    def _upper_bounds(cls) -> typing.List[int]:
+        """Returns the exclusive upper bound of each bucket, which only depends on the class."""
+        if cls._upper_bounds_cache is None:
+            cls._upper_bounds_cache = [cls._lower_bound(i + 1) for i in range(cls._index(cls.MAX_VALUE) + 1)]
+        return cls._upper_bounds_cache
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        elif value > self.__class__.MAX_VALUE:
+            value = self.__class__.MAX_VALUE
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencyHistogram"):
+        self.counts = list(map(operator.add, self.counts, other.counts))
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> int:
+        if not self.count:
+            return 0
+        remaining = self.count * percent / 100
+        for i, count in enumerate(self.counts):
+            remaining -= count
+            if remaining <= 0:
+                return min(self.max, self._lower_bound(i + 1) - 1)
+        return self.max
+
+    def count_below(self, value: int) -> int:
+        """Returns the number of recorded values in buckets entirely below value."""
+        return self.counts_below((value,))[0]
+
+    def counts_below(self, values: typing.Iterable[int]) -> typing.List[int]:
+        """Returns count_below of each of values, given in ascending order, going over the buckets once."""
+        upper_bounds = self._upper_bounds()
+        res = []
+        total = 0
+        begin = 0
+        for value in values:
+            end = bisect.bisect_right(upper_bounds, value, begin)
+            total += sum(self.counts[begin:end])
+            begin = end
+            res.append(total)
+        return res
+
+
+class DirectionStats:
+    """Timings of the steps that data relayed in one direction goes through."""
+
+    STAGES: typing.ClassVar[typing.Tuple[str, ...]] = ("dwell", "parse", "decompress", "compress", "process")
+
+    def __init__(self):
+        self.bytes = 0
+        self.bundles = 0
+        # Number of times reading paused, because too much was waiting to be written in this direction of a
+        # connection, or in total.
+        self.overflows = 0
+        self.global_overflows = 0
+        # From the moment data is read, until whatever it turned into has been handed to the other side.
+        self.dwell = LatencyHistogram()
+        # Finding and validating bundle headers. Messages are not decompressed yet.
+        self.parse = LatencyHistogram()
+        self.decompress = LatencyHistogram()
+        self.compress = LatencyHistogram()
+        # Calls to source_to_destination and destination_to_source, including decompressing the messages of bundles
+        # that they look into, which is also recorded in decompress.
+        self.process = LatencyHistogram()
+
+    def merge(self, other: "DirectionStats"):
+        self.bytes += other.bytes
+        self.bundles += other.bundles
+        self.overflows += other.overflows
+        self.global_overflows += other.global_overflows
+        for stage in self.__class__.STAGES:
+            getattr(self, stage).merge(getattr(other, stage))
+
+
+class ConnectionStats:
+    DIRECTIONS: typing.ClassVar[typing.Tuple[str, ...]] = ("S2D", "D2S")
+
+    def __init__(self):
+        self.directions = {x: DirectionStats() for x in self.__class__.DIRECTIONS}
+        # From an action request being read from the client, until the matching ActionEffect is read from the server.
+        self.action_rtt = LatencyHistogram()
+        # Connecting to the server.
+        self.handshake = LatencyHistogram()
+        # From accepting the client, until the first data from the client has been written to the server.
+        self.first_byte = LatencyHistogram()
+
+    def merge(self, other: "ConnectionStats"):
+        for direction, stats in self.directions.items():
+            stats.merge(other.directions[direction])
+        self.action_rtt.merge(other.action_rtt)
+        self.handshake.merge(other.handshake)
+        self.first_byte.merge(other.first_byte)
+
+
+class StatsRegistry:
+    """Renders statistics of every connection, past and present."""
+
+    PROMETHEUS_BUCKETS: typing.ClassVar[typing.Tuple[float, ...]] = (
+        0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.,
+        2., 5.)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.closed = ConnectionStats()
+        self.closed_connections = 0
+
+    def retire(self, connection: "Connection"):
+        """Forgets about a closed connection, keeping its statistics in the totals."""
+        with self.lock:
+            Connection.all_connections.remove(connection)
+            self.closed.merge(connection.stats)
+            self.closed_connections += 1
+
+    def _collect(self) -> typing.Tuple[ConnectionStats, typing.List[typing.Tuple[int, ConnectionStats]]]:
+        with self.lock:
+            total = ConnectionStats()
+            total.merge(self.closed)
+            live = [(x.conn_id, x.stats) for x in list(Connection.all_connections)]
+        for _, stats in live:
+            total.merge(stats)
+        return total, live
+
+    def render_prometheus(self) -> str:
+        total, live = self._collect()
+        lines = [
+            "# TYPE xiv_mitm_connections gauge",
+            f"xiv_mitm_connections {len(live)}",
+            "# TYPE xiv_mitm_connections_closed_total counter",
+            f"xiv_mitm_connections_closed_total {self.closed_connections}",
+        ]
+        series = [("", total)] + [(f'conn="{conn_id}",', stats) for conn_id, stats in live]
+        # Histograms are only rendered for the totals; per connection, they would make up most of the output and of
+        # the time it takes to render, while the relaying threads wait.
+
+        for name, attr in (("bytes", "bytes"), ("bundles", "bundles")):
+            lines.append(f"# TYPE xiv_mitm_{name}_total counter")
+            for labels, stats in series:
+                for direction, direction_stats in stats.directions.items():
+                    lines.append(f'xiv_mitm_{name}_total{{{labels}direction="{direction}"}} '
+                                 f'{getattr(direction_stats, attr)}')
+
+        lines.append("# TYPE xiv_mitm_buffer_overflows_total counter")
+        for labels, stats in series:
+            for direction, direction_stats in stats.directions.items():
+                for scope, attr in (("connection", "overflows"), ("global", "global_overflows")):
+                    lines.append(f'xiv_mitm_buffer_overflows_total{{{labels}direction="{direction}",scope="{scope}"}} '
+                                 f'{getattr(direction_stats, attr)}')
+        lines.append("# TYPE xiv_mitm_buffered_bytes gauge")
+        lines.append(f"xiv_mitm_buffered_bytes {buffer_budget.used}")
+        lines.append("# TYPE xiv_mitm_log_records_lost_total counter")
+        lines.append(f'xiv_mitm_log_records_lost_total{{reason="dropped"}} {log_writer.dropped}')
+        lines.append(f'xiv_mitm_log_records_lost_total{{reason="failed"}} {log_writer.failed}')
+
+        lines.append("# TYPE xiv_mitm_stage_seconds histogram")
+        for direction, direction_stats in total.directions.items():
+            for stage in DirectionStats.STAGES:
+                lines.extend(self._render_histogram("xiv_mitm_stage_seconds", getattr(direction_stats, stage),
+                                                    f'direction="{direction}",stage="{stage}"'))
+
+        for name, attr in (("action_rtt", "action_rtt"), ("handshake", "handshake"), ("first_byte", "first_byte")):
+            lines.append(f"# TYPE xiv_mitm_{name}_seconds histogram")
+            lines.extend(self._render_histogram(f"xiv_mitm_{name}_seconds", getattr(total, attr), ""))
+        return "\n".join(lines) + "\n"
+
+    def _render_histogram(self, name: str, histogram: LatencyHistogram, labels: str) -> typing.List[str]:
+        separator = "," if labels else ""
+        buckets = self.__class__.PROMETHEUS_BUCKETS
+        res = [f'{name}_bucket{{{labels}{separator}le="{x}"}} {count}'
+               for x, count in zip(buckets, histogram.counts_below(int(x * 1e9) for x in buckets))]
+        res.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram.count}')
+        labels = f"{{{labels}}}" if labels else ""
+        res.append(f"{name}_sum{labels} {histogram.sum / 1e9}")
+        res.append(f"{name}_count{labels} {histogram.count}")
+        return res
+
+    def render_summary(self) -> str:
+        total, live = self._collect()
+        lines = [f"Connections: {len(live)} open, {self.closed_connections} closed"]
+
+        def describe(histogram: LatencyHistogram) -> str:
+            return (f"n={histogram.count} p50={histogram.percentile(50) / 1e6:.3f}ms "
+                    f"p99={histogram.percentile(99) / 1e6:.3f}ms max={histogram.max / 1e6:.3f}ms")
+
+        for direction, direction_stats in total.directions.items():
+            lines.append(f"{direction}: {direction_stats.bytes} bytes, {direction_stats.bundles} bundles, "
+                         f"{direction_stats.overflows}+{direction_stats.global_overflows} buffer overflows")
+            for stage in DirectionStats.STAGES:
+                lines.append(f"  {stage:<10} {describe(getattr(direction_stats, stage))}")
+        lines.append(f"Action round trip: {describe(total.action_rtt)}")
+        lines.append(f"Handshake: {describe(total.handshake)}")
+        lines.append(f"First byte: {describe(total.first_byte)}")
+        lines.append(f"Log records: {log_writer.dropped} dropped, {log_writer.failed} failed")
+        return "\n".join(lines)
+
+
+stats_registry = StatsRegistry()
+
+
+class StatsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._respond(200, stats_registry.render_prometheus(), "text/plain; version=0.0.4")
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/profile":
+            self._respond(404, "Not found\n")
+            return
+        try:
+            seconds = float(urllib.parse.parse_qs(url.query).get("seconds", [runtime_profiler.seconds])[0])
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= RuntimeProfiler.MAX_SECONDS:
+            self._respond(400, f"seconds must be between 0 and {RuntimeProfiler.MAX_SECONDS}\n")
+            return
+        path = runtime_profiler.start(seconds)
+        if path is None:
+            self._respond(409, "Already profiling\n")
+        else:
+            self._respond(202, f"Profiling for {seconds:g}s into {path}.pstats\n")
+
+    def _respond(self, code: int, text: str, content_type: str = "text/plain"):
+        body = text.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
 class StructBase:
+    """Fields are read from and written to the underlying buffer on access, using accessors generated per class."""
+
+    __slots__ = ("_buffer", "_offset")
+
     DEFINITION: typing.ClassVar[struct.Struct]
     ALL_TYPES: typing.ClassVar[typing.List[str]]
-    _types: typing.List[str]
+    FIELDS: typing.ClassVar[typing.List[str]]
+
+    _ITEM_PATTERN: typing.ClassVar[typing.Pattern] = re.compile(r"(\d*)([xcbB?hHiIlLqQnNefdspP])")
 
     def __init_subclass__(cls, definition: str = "", **kwargs):
+        super().__init_subclass__(**kwargs)
         cls.DEFINITION = struct.Struct(definition)
         cls.ALL_TYPES = list(x for x in typing.get_type_hints(cls).keys() if x[0] != "_" and x.islower())
 
-    def __init__(self, data: bytes, offset: int):
+        byte_order = definition[:1] if definition[:1] in "@=<>!" else ""
+        cls.FIELDS = []
+        offset = 0
+        for count, code in StructBase._ITEM_PATTERN.findall(definition):
+            count = int(count) if count else 1
+            if code in "sp":
+                items = [f"{byte_order}{count}{code}"]
+            else:
+                items = [f"{byte_order}{code}"] * count
+            for item in items:
+                item = struct.Struct(item)
+                if code != "x":
+                    name = cls.ALL_TYPES[len(cls.FIELDS)]
+                    cls.FIELDS.append(name)
+                    setattr(cls, name, StructBase._make_accessor(item, offset))
+                offset += item.size
+
+    @staticmethod
+    def _make_accessor(item: struct.Struct, offset: int) -> property:
+        unpack_from = item.unpack_from
+        pack_into = item.pack_into
+
+        def getter(self: "StructBase"):
+            return unpack_from(self._buffer, self._offset + offset)[0]
+
+        def setter(self: "StructBase", value):
+            pack_into(self._buffer, self._offset + offset, value)
+
+        return property(getter, setter)
+
+    def __init__(self, data: typing.Union[bytes, bytearray, memoryview], offset: int):
         if len(data) - offset < self.__class__.DEFINITION.size:
             raise IncompleteDataException
-        unpacked = self.__class__.DEFINITION.unpack(data[offset:offset + self.__class__.DEFINITION.size])
-        self._types = []
-        for key, value in zip(self.__class__.ALL_TYPES, unpacked):
-            setattr(self, key, value)
-            self._types.append(key)
+        self._buffer = data
+        self._offset = offset
+
+    @classmethod
+    def header_of(cls, data: typing.Union[bytes, bytearray, memoryview], offset: int = 0):
+        """Returns an instance only exposing the fields in DEFINITION, skipping what subclass constructors do."""
+        self = cls.__new__(cls)
+        StructBase.__init__(self, data, offset)
+        return self
 
     def __str__(self):
-        return f"{self.__class__.__name__}({', '.join(f'{x}={getattr(self, x)}' for x in self.__class__.ALL_TYPES)})"
+        values = ((x, getattr(self, x)) for x in self.__class__.ALL_TYPES)
+        return f"{self.__class__.__name__}(" \
+               f"{', '.join(f'{x}={bytes(y) if type(y) is memoryview else y}' for x, y in values)})"
 
     def __repr__(self):
         return self.__str__()
 
     def __bytes__(self):
-        return self.__class__.DEFINITION.pack(*[getattr(self, x) for x in self._types])
+        return bytes(memoryview(self._buffer)[self._offset:self._offset + self.__class__.DEFINITION.size])
 
 
 class XivMessageIpcActionEffect(StructBase, definition="<I4sIIfIHHHBB1sB2s"):
+    __slots__ = ()
+
     animation_target_actor: int  # I: uint32
     unknown_1: bytes  # 4s: char x 4
     action_id: int  # I: uint32
@@ -89,6 +826,8 @@ class XivMessageIpcActionEffect(StructBase, definition="<I4sIIfIHHHBB1sB2s"):
 
 
 class XivMessageIpcActorControl(StructBase, definition="<H2sIIII4s"):
+    __slots__ = ()
+
     CATEGORY_CANCEL_CAST: typing.ClassVar = 0x000f
 
     category: int  # H: uint16
@@ -101,6 +840,8 @@ class XivMessageIpcActorControl(StructBase, definition="<H2sIIII4s"):
 
 
 class XivMessageIpcActorControlSelf(StructBase, definition="<H2sIIIIII4s"):
+    __slots__ = ()
+
     CATEGORY_ROLLBACK: typing.ClassVar = 0x02bc
 
     category: int  # H: uint16
@@ -115,6 +856,8 @@ class XivMessageIpcActorControlSelf(StructBase, definition="<H2sIIIIII4s"):
 
 
 class XivMessageIpcActorCast(StructBase, definition="<HB1sH2sfIf4sHHH2s"):
+    __slots__ = ()
+
     action_id: int  # H: uint16
     skill_type: int  # B: uint8
     unknown_1: bytes  # 1s: char x 1
@@ -131,6 +874,8 @@ class XivMessageIpcActorCast(StructBase, definition="<HB1sH2sfIf4sHHH2s"):
 
 
 class XivMessageIpc(StructBase, definition="<HH2sHI4s"):
+    __slots__ = ("data",)
+
     TYPE_INTERESTED: typing.ClassVar = 0x14  # not interested in anything else at the moment, hence the meaningless name
 
     type: int  # H: uint16
@@ -139,18 +884,20 @@ class XivMessageIpc(StructBase, definition="<HH2sHI4s"):
     server_id: int  # H: uint16
     epoch: int  # I: uint32
     unknown2: bytes  # 4s: char x 4
-    data: bytes
+    data: memoryview
 
-    def __init__(self, data: bytes, offset: int):
+    def __init__(self, data: typing.Union[bytes, bytearray, memoryview], offset: int):
         super().__init__(data, offset)
 
-        self.data = data[offset + self.__class__.DEFINITION.size:]
+        self.data = memoryview(data)[offset + self.__class__.DEFINITION.size:]
 
     def __bytes__(self):
         return super().__bytes__() + self.data
 
 
 class XivMessage(StructBase, definition="<IIIH2s"):
+    __slots__ = ("data",)
+
     SEGMENT_TYPE_IPC: typing.ClassVar = 3
 
     length: int  # I: uint32
@@ -159,15 +906,15 @@ class XivMessage(StructBase, definition="<IIIH2s"):
     segment_type: int  # H: uint16
     unknown1: bytes  # 2s: char x 2
 
-    data: bytes
+    data: memoryview
 
-    def __init__(self, data: bytes, offset: int):
+    def __init__(self, data: typing.Union[bytes, bytearray, memoryview], offset: int):
         super().__init__(data, offset)
 
         if len(data) - offset < self.length:
             raise IncompleteDataException
 
-        self.data = data[offset + self.__class__.DEFINITION.size:offset + self.length]
+        self.data = memoryview(data)[offset + self.__class__.DEFINITION.size:offset + self.length]
 
     def __bytes__(self):
         res = super().__bytes__() + self.data
@@ -175,10 +922,19 @@ class XivMessage(StructBase, definition="<IIIH2s"):
 
 
 class XivBundle(StructBase, definition="<16sQH2sHHBB6s"):
+    __slots__ = ("dirty", "received_at", "decompress_ns", "compress_ns", "_raw", "_message_data", "_messages")
+
     MAGIC_CONSTANT_1: typing.ClassVar[bytes] = b"\x52\x52\xa0\x41\xff\x5d\x46\xe2\x7f\x2a\x64\x4d\x7b\x99\xc4\x75"
     MAGIC_CONSTANT_2: typing.ClassVar[bytes] = b"\0" * 16
     MAX_LENGTH: typing.ClassVar[int] = 65536
 
+    _MAGIC_PATTERN: typing.ClassVar[typing.Pattern] = re.compile(re.escape(MAGIC_CONSTANT_1) + b"|" +
+                                                               re.escape(MAGIC_CONSTANT_2))
+    _NONZERO_PATTERN: typing.ClassVar[typing.Pattern] = re.compile(b"[^\0]")
+    # Message header followed by IPC type and subtype.
+    _IPC_PREFIX: typing.ClassVar[struct.Struct] = struct.Struct("<IIIH2sHH")
+    _MESSAGE_LENGTH: typing.ClassVar[struct.Struct] = struct.Struct("<I")
+
     magic: bytes  # 16s: char x 16
     timestamp: int  # Q: uint64
     length: int  # H: uint16
@@ -189,174 +945,918 @@ class XivBundle(StructBase, definition="<16sQH2sHHBB6s"):
     zlib_compressed: int  # B: uint8
     unknown2: bytes  # 6s: char x 6
     messages: typing.List["XivMessage"]
-
-    def __init__(self, data: bytes, offset: int):
+    dirty: bool
+    received_at: float
+    decompress_ns: int
+    compress_ns: int
+    _raw: memoryview
+    _message_data: typing.Optional[typing.Union[bytearray, memoryview]]
+    _messages: typing.Optional[typing.List["XivMessage"]]
+
+    def __init__(self, data: typing.Union[bytearray, memoryview], offset: int, received_at: float):
+        """Messages are only checked to be laid out plausibly here; they are decompressed and split on first access.
+
+        Uncompressed messages are modified in place, so data has to be writable. received_at is when the data arrived,
+        in seconds since epoch."""
         super().__init__(data, offset)
+        self.dirty = False
+        self.received_at = received_at
+        self.decompress_ns = self.compress_ns = 0
 
         if self.magic not in (XivBundle.MAGIC_CONSTANT_1, XivBundle.MAGIC_CONSTANT_2):
             raise InvalidDataException
 
-        if self.length > self.__class__.MAX_LENGTH:
+        if not self.is_plausible():
             raise InvalidDataException
 
         if len(data) - offset < self.length:
             raise IncompleteDataException
 
-        msg_data = data[offset + self.__class__.DEFINITION.size:offset + self.length]
-        offset += self.__class__.DEFINITION.size
+        # Keep the original wire bytes around, so that untouched bundles can be forwarded as they came in.
+        self._raw = memoryview(data)[offset:offset + self.length]
+        if self._raw.readonly:
+            raise TypeError("XivBundle requires writable data")
+        self._message_data = self._messages = None
+
+        if not self.has_plausible_messages():
+            raise InvalidDataException
+
+    @property
+    def messages(self) -> typing.List["XivMessage"]:
+        """Raises InvalidDataException on first access if messages cannot be decompressed or split."""
+        if self._messages is not None:
+            return self._messages
+
+        msg_data = self._raw[self.__class__.DEFINITION.size:]
 
+        # Messages are modified in place, so decompressed data has to be writable.
         if self.zlib_compressed:
+            started_at = time.perf_counter_ns()
             try:
-                msg_data = zlib.decompress(msg_data)
+                msg_data = bytearray(zlib.decompress(msg_data))
             except zlib.error:
                 raise InvalidDataException
+            self.decompress_ns = time.perf_counter_ns() - started_at
+        messages = list()
         msg_offset = 0
-        self.messages = list()
         for i in range(0, self.message_count):
             try:
-                self.messages.append(XivMessage(msg_data, msg_offset))
+                messages.append(XivMessage(msg_data, msg_offset))
             except IncompleteDataException:
                 raise InvalidDataException
-            msg_offset += self.messages[-1].length
+            msg_offset += messages[-1].length
             if msg_offset > len(msg_data):
                 raise InvalidDataException
+        self._message_data = msg_data
+        self._messages = messages
+        return messages
+
+    def may_contain_ipc(self, subtypes: typing.Container[int], self_only: bool = False) -> bool:
+        """Tells whether any message may be an interesting IPC of one of subtypes, without decompressing.
+
+        Compressed bundles are assumed to contain one, unless already decompressed; RegionProfile.conn_types_without_ipc
+        is what lets those of chat skip decompression. With self_only, only messages whose source and target actors are
+        the same count."""
+        if not self.message_count:
+            return False
+        if self._messages is None and self.zlib_compressed:
+            return True
+        data = self._raw if self._messages is None else self._message_data
+        offset = self.__class__.DEFINITION.size if self._messages is None else 0
+        end = len(data)
+        ipc_prefix = self.__class__._IPC_PREFIX
+        for _ in range(0, self.message_count):
+            if offset + ipc_prefix.size > end:
+                # Nothing left that is long enough to hold an IPC header.
+                return False
+            length, source_actor, target_actor, segment_type, _, ipc_type, subtype = \
+                ipc_prefix.unpack_from(data, offset)
+            if length < XivMessage.DEFINITION.size:
+                return True
+            if segment_type == XivMessage.SEGMENT_TYPE_IPC and ipc_type == XivMessageIpc.TYPE_INTERESTED \
+                    and subtype in subtypes and (not self_only or source_actor == target_actor):
+                return True
+            offset += length
+        return False
 
     def __bytes__(self):
-        data = b"".join(bytes(x) for x in self.messages)
+        return bytes(self.to_wire())
+
+    def to_wire(self) -> typing.Union[bytes, memoryview]:
+        """Returns what should be sent in place of this bundle.
+
+        Messages are modified in place, so this is the original slice unless compressed data has to be redone."""
+        if not self.dirty or not self.zlib_compressed:
+            return self._raw
+        started_at = time.perf_counter_ns()
+        data = zlib.compress(self._message_data)
+        self.compress_ns = time.perf_counter_ns() - started_at
+        header = bytearray(self._raw[:self.__class__.DEFINITION.size])
+        XivBundle.header_of(header).length = len(header) + len(data)
+        return bytes(header) + data
+
+    def is_plausible(self) -> bool:
+        """Tells whether the header fields other than magic make sense, without looking at the messages."""
+        header_size = self.__class__.DEFINITION.size
+        length = self.length
+        if not header_size <= length <= self.__class__.MAX_LENGTH:
+            return False
+        zlib_compressed = self.zlib_compressed
+        if zlib_compressed > 1:
+            return False
+        if not zlib_compressed and self.message_count * XivMessage.DEFINITION.size > length - header_size:
+            return False
+        return True
+
+    def has_plausible_messages(self) -> bool:
+        """Tells whether messages could be split, without decompressing or splitting them.
+
+        For compressed bundles, only the zlib header is checked. This is what keeps find from taking a magic that
+        happens to appear in garbage, followed by a plausible header, for a bundle swallowing the real ones after it."""
+        raw = self._raw
+        offset = self.__class__.DEFINITION.size
+        end = len(raw)
         if self.zlib_compressed:
-            data = zlib.compress(data)
-        self.length = self.__class__.DEFINITION.size + len(data)
-        res = super().__bytes__() + data
-        return res
+            if end - offset < 2:
+                return False
+            method, flags = raw[offset], raw[offset + 1]
+            # Deflate with a window of at most 32 KiB, a valid check value, and no preset dictionary.
+            return method & 0x0f == 8 and method >> 4 <= 7 and not ((method << 8) | flags) % 31 and not flags & 0x20
+        header_size = XivMessage.DEFINITION.size
+        message_length = self.__class__._MESSAGE_LENGTH
+        for _ in range(0, self.message_count):
+            if offset + header_size > end:
+                return False
+            offset += message_length.unpack_from(raw, offset)[0]
+            if offset > end:
+                return False
+        return True
 
     @classmethod
-    def find(cls, data: bytes):
-        offset = 0
-        while offset < len(data):
-            available_bytes = len(data) - offset
-            if available_bytes >= len(cls.MAGIC_CONSTANT_1):
-                mc1 = data.find(cls.MAGIC_CONSTANT_1, offset)
-                mc2 = data.find(cls.MAGIC_CONSTANT_2, offset)
-            else:
-                mc1 = data.find(cls.MAGIC_CONSTANT_1[:available_bytes], offset)
-                mc2 = data.find(cls.MAGIC_CONSTANT_2[:available_bytes], offset)
-            if mc1 == -1:
-                i = mc2
-            elif mc2 == -1:
-                i = mc1
-            else:
-                i = min(mc1, mc2)
-            if i == -1:  # no hope
-                yield data[offset:]
+    def find(cls, data: typing.Union[bytearray, memoryview], offset: int = 0, end: typing.Optional[int] = None, *,
+             received_at: float):
+        """Yields XivBundles and discarded fragments as memoryviews; returns the offset of unconsumed data.
+
+        Yielded bundles arrived at received_at, in seconds since epoch.
+
+        Data between bundles is yielded as one contiguous fragment, however many false starts it contains. Data has to
+        be writable, as bundles are modified in place."""
+        if end is None:
+            end = len(data)
+        view = memoryview(data)[:end]
+        if view.readonly:
+            raise TypeError("XivBundle.find requires writable data")
+        header_size = cls.DEFINITION.size
+        search = cls._MAGIC_PATTERN.search
+        discard_from = offset
+        while offset < end:
+            match = search(data, offset, end)
+            if match is None:
+                # Keep what might be the beginning of a magic for the next call.
+                offset = max(offset, end - len(cls.MAGIC_CONSTANT_1) + 1)
+                while offset < end and not (cls.MAGIC_CONSTANT_1.startswith(data[offset:end]) or
+                                            cls.MAGIC_CONSTANT_2.startswith(data[offset:end])):
+                    offset += 1
                 break
-            if i != offset:
-                yield data[offset:i]
-                offset = i
 
-            if len(data) < offset + cls.DEFINITION.size:
-                return data[offset:]
+            offset = match.start()
+            if end - offset < header_size:
+                break
+
+            header = cls.header_of(view, offset)
+            if not header.is_plausible():
+                if header.length == 0:
+                    # Inside a run of zeroes, every header that fits in it is empty; skip to where it could end.
+                    nonzero = cls._NONZERO_PATTERN.search(data, offset, end)
+                    offset = max(offset + 1, (end if nonzero is None else nonzero.start()) - header_size + 1)
+                else:
+                    offset += 1
+                continue
+
+            length = header.length
+            if end - offset < length:
+                break
 
             try:
-                bundle = XivBundle(data, offset)
-                offset += bundle.length
-                # bundle.length might be modified from this point
-                yield bundle
-            except IncompleteDataException:
-                return data[offset:]
+                bundle = XivBundle(view, offset, received_at)
             except InvalidDataException:
-                yield data[offset:offset + 1]
                 offset += 1
-        return b""
+                continue
+
+            if discard_from != offset:
+                yield view[discard_from:offset]
+            # bundle.length might be modified from this point
+            yield bundle
+            offset += length
+            discard_from = offset
+
+        if discard_from != offset:
+            yield view[discard_from:offset]
+        return offset
+
+
+class XivBundleFramer:
+    """Receive buffer for a stream of XivBundles, meant to be filled in place using recv_into."""
+
+    READ_SIZE: typing.ClassVar[int] = 65536
+    CAPACITY: typing.ClassVar[int] = XivBundle.MAX_LENGTH * 2 + READ_SIZE
+
+    def __init__(self):
+        self.buffer = bytearray(self.__class__.CAPACITY)
+        self.view = memoryview(self.buffer)
+        self.begin = 0
+        self.end = 0
+        # Number of bytes that have to be available from self.begin before it's worth scanning again.
+        self.need = 0
+        # When the last committed data arrived, in seconds since epoch; bundles completed by it arrived then.
+        self.received_at = 0.
+
+    def writable(self) -> memoryview:
+        if self.begin == self.end:
+            self.begin = self.end = 0
+        elif len(self.buffer) - self.end < self.__class__.READ_SIZE:
+            pending = self.end - self.begin
+            self.view[:pending] = self.view[self.begin:self.end]
+            self.begin, self.end = 0, pending
+        return self.view[self.end:]
+
+    def commit(self, length: int, received_at: float):
+        self.end += length
+        self.received_at = received_at
+
+    def take(self) -> memoryview:
+        res = self.view[self.begin:self.end]
+        self.begin = self.end
+        self.need = 0
+        return res
+
+    def __iter__(self) -> typing.Iterator[typing.Union[XivBundle, memoryview]]:
+        """Yields XivBundles and discarded fragments. Yielded items are only valid until the next call to writable."""
+        if self.end - self.begin < self.need:
+            return
+        it = XivBundle.find(self.buffer, self.begin, self.end, received_at=self.received_at)
+        while True:
+            try:
+                item = next(it)
+            except StopIteration as e:
+                self.begin = e.value
+                break
+            yield item
+
+        pending = self.end - self.begin
+        if pending < XivBundle.DEFINITION.size:
+            self.need = XivBundle.DEFINITION.size if pending else 0
+        else:
+            self.need = max(XivBundle.DEFINITION.size, XivBundle.header_of(self.buffer, self.begin).length)
+
+
+class BufferBudget:
+    """Limits how much the asyncio engine holds waiting to be written, in each direction of a connection and in total.
+
+    When a limit is hit, reading from the side that sent the data pauses, until enough of it has been written out.
+    Zero disables a limit."""
+
+    CHECK_INTERVAL: typing.ClassVar[float] = 0.01
+
+    def __init__(self, per_direction: int = 1 << 20, total: int = 64 << 20):
+        self.per_direction = per_direction
+        self.total = total
+        self.used = 0
+        # What each protocol had waiting in the transport of its peer when last checked.
+        self.pending: typing.Dict["RelayProtocol", int] = {}
+        self.paused: typing.Set["RelayProtocol"] = set()
+        self.check_handle: typing.Optional[asyncio.TimerHandle] = None
+
+    def charge(self, protocol: "RelayProtocol"):
+        """Accounts for what protocol just wrote to its peer, pausing it if that went over the total limit."""
+        if not self.total:
+            return
+        self._update(protocol)
+        if self.used <= self.total:
+            return
+        # Others may have written some out since their last write.
+        for x in list(self.pending):
+            self._update(x)
+        if self.used > self.total and protocol not in self.paused:
+            self.paused.add(protocol)
+            protocol.pause_reading("global")
+            protocol.connection.stats.directions[protocol.log_prefix].global_overflows += 1
+            if self.check_handle is None:
+                self.check_handle = asyncio.get_running_loop().call_later(self.__class__.CHECK_INTERVAL, self._check)
+
+    def release(self, protocol: "RelayProtocol"):
+        self.used -= self.pending.pop(protocol, 0)
+        self.paused.discard(protocol)
+
+    def _update(self, protocol: "RelayProtocol"):
+        transport = protocol.peer.transport
+        size = transport.get_write_buffer_size() if transport is not None and not transport.is_closing() else 0
+        self.used += size - self.pending.pop(protocol, 0)
+        if size:
+            self.pending[protocol] = size
+
+    def _check(self):
+        self.check_handle = None
+        for x in list(self.pending):
+            self._update(x)
+        if self.used <= self.total // 2:
+            paused, self.paused = self.paused, set()
+            for x in paused:
+                x.resume_reading("global")
+        elif self.paused:
+            self.check_handle = asyncio.get_running_loop().call_later(self.__class__.CHECK_INTERVAL, self._check)
+
+
+buffer_budget = BufferBudget()
+
+
+class RelayProtocol(asyncio.BufferedProtocol):
+    """One direction of a Connection, for use with the asyncio relay engine."""
+
+    def __init__(self, connection: "Connection", process_fn: typing.Callable[[XivBundle], XivBundle],
+                 log_prefix: str):
+        self.connection = connection
+        self.process_fn = process_fn
+        self.log_prefix = log_prefix
+        self.framer = XivBundleFramer()
+        self.transport: typing.Optional[asyncio.Transport] = None
+        self.sock: typing.Optional[socket.socket] = None
+        self.quickack = False
+        self.peer: typing.Optional[RelayProtocol] = None
+        # What was read before peer was connected.
+        self.backlog: typing.List[bytes] = []
+        self.closed = asyncio.get_running_loop().create_future()
+        self.lost = asyncio.get_running_loop().create_future()
+        # Reasons reading is paused for.
+        self.paused_by: typing.Set[str] = set()
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.sock = transport.get_extra_info("socket")
+        self.quickack = Connection.TCP_QUICKACK is not None
+        if buffer_budget.per_direction:
+            transport.set_write_buffer_limits(high=buffer_budget.per_direction)
+        if self.peer.backlog:
+            transport.writelines(self.peer.backlog)
+            self.peer.backlog = []
+            self.peer.wrote()
+        self.peer.resume_reading("peer")
+
+    def pause_reading(self, reason: str):
+        if not self.paused_by:
+            self.transport.pause_reading()
+        self.paused_by.add(reason)
+
+    def resume_reading(self, reason: str):
+        if reason not in self.paused_by:
+            return
+        self.paused_by.remove(reason)
+        if not self.paused_by and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        # Our transport is what peer writes what it reads to.
+        if not buffer_budget.per_direction:
+            return
+        self.peer.pause_reading("connection")
+        self.connection.stats.directions[self.peer.log_prefix].overflows += 1
+
+    def resume_writing(self):
+        self.peer.resume_reading("connection")
+
+    def connection_lost(self, exc: typing.Optional[Exception]):
+        if not self.closed.done():
+            self.closed.set_result(None)
+        if not self.lost.done():
+            self.lost.set_result(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.framer.writable()
+
+    def buffer_updated(self, nbytes: int):
+        received_at = time.perf_counter_ns()
+        if self.quickack:
+            # Kernel turns this off again from time to time.
+            self.sock.setsockopt(socket.IPPROTO_TCP, Connection.TCP_QUICKACK, 1)
+        self.connection.commit_received(self.framer, nbytes, self.log_prefix, time.time_ns())
+        self.write(self.connection.process_received(self.framer, self.process_fn, self.log_prefix))
+        self.connection.stats.directions[self.log_prefix].dwell.record(time.perf_counter_ns() - received_at)
+
+    def eof_received(self) -> bool:
+        self.write([self.framer.take()])
+        if not self.closed.done():
+            self.closed.set_result(None)
+        return False
+
+    def write(self, data: typing.List[typing.Union[bytes, memoryview]]):
+        # Transports may hold on to what could not be sent right away, but views into the framer will be overwritten
+        # on next read, so they have to be copied.
+        data = [bytes(x) if type(x) is memoryview else x for x in data if x]
+        if not data:
+            return
+        if self.peer.transport is None:
+            self.backlog.extend(data)
+            if sum(len(x) for x in self.backlog) > (buffer_budget.per_direction or XivBundleFramer.CAPACITY):
+                self.pause_reading("peer")
+            return
+        self.peer.transport.writelines(data)
+        self.wrote()
+
+    def wrote(self):
+        buffer_budget.charge(self)
+        if self.log_prefix == "S2D" and self.connection.accepted_at is not None:
+            self.connection.record_first_byte()
+
+
+class SplicePump:
+    """One direction of a Connection not worth inspecting, moved inside the kernel by the asyncio relay engine."""
+
+    def __init__(self, source: socket.socket, destination: socket.socket):
+        self.loop = asyncio.get_running_loop()
+        self.source_fd = source.fileno()
+        self.destination_fd = destination.fileno()
+        self.read_fd, self.write_fd = os.pipe()
+        self.pending = 0
+        self.closed = self.loop.create_future()
+        self.loop.add_reader(self.source_fd, self._on_readable)
+
+    def _on_readable(self):
+        try:
+            self.pending = os.splice(self.source_fd, self.write_fd, Connection.SPLICE_SIZE,
+                                     flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            return
+        if not self.pending:
+            self.close()
+            return
+        self._on_writable()
+
+    def _on_writable(self):
+        while self.pending:
+            try:
+                self.pending -= os.splice(self.read_fd, self.destination_fd, self.pending,
+                                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except BlockingIOError:
+                # Stop reading until the destination catches up.
+                if self.loop.remove_reader(self.source_fd):
+                    self.loop.add_writer(self.destination_fd, self._on_writable)
+                return
+            except OSError:
+                self.close()
+                return
+        if self.loop.remove_writer(self.destination_fd):
+            self.loop.add_reader(self.source_fd, self._on_readable)
+
+    def close(self):
+        if self.closed.done():
+            return
+        self.loop.remove_reader(self.source_fd)
+        self.loop.remove_writer(self.destination_fd)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+        self.closed.set_result(None)
+
+
+class SessionCapture:
+    """Append-only record of data read from both sides of a connection, in chunks as they were read."""
+
+    MAGIC: typing.ClassVar[bytes] = b"XIVCAP\x01\x00"
+    DIRECTIONS: typing.ClassVar[typing.Tuple[str, ...]] = ("S2D", "D2S")
+    # magic, destination ip, destination port, region
+    HEADER: typing.ClassVar[struct.Struct] = struct.Struct("<8s4sH16s")
+    # when the data arrived in nanoseconds since epoch, index of direction, length of data following this record
+    RECORD: typing.ClassVar[struct.Struct] = struct.Struct("<QBI")
+
+    def __init__(self, path: str, destination: typing.Tuple[str, int], region: str):
+        self.lock = threading.Lock()
+        # Each file holds exactly one session, as the header only describes one. Sessions include chat, so only the
+        # owner may read them.
+        self.file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb")
+        self.file.write(self.__class__.HEADER.pack(self.__class__.MAGIC, socket.inet_aton(destination[0]),
+                                                   destination[1], region.encode("utf-8")))
+
+    def record(self, direction: str, data: memoryview, received_at: int):
+        header = self.__class__.RECORD.pack(received_at, self.__class__.DIRECTIONS.index(direction), len(data))
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(header)
+            self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class SessionReplay:
+    """Reads a file written by SessionCapture, without copying the recorded data."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        if len(self.view) < SessionCapture.HEADER.size:
+            raise InvalidDataException
+        magic, ip, port, region = SessionCapture.HEADER.unpack_from(self.view, 0)
+        if magic != SessionCapture.MAGIC:
+            raise InvalidDataException
+        self.destination = (socket.inet_ntoa(ip), port)
+        self.region = region.rstrip(b"\0").decode("utf-8")
+
+    def __iter__(self) -> typing.Iterator[typing.Tuple[int, str, memoryview]]:
+        """Yields timestamp in nanoseconds, direction, and data of each record. An incomplete last one is skipped."""
+        offset = SessionCapture.HEADER.size
+        record = SessionCapture.RECORD
+        while offset + record.size <= len(self.view):
+            timestamp, direction, length = record.unpack_from(self.view, offset)
+            offset += record.size
+            if offset + length > len(self.view):
+                break
+            yield timestamp, SessionCapture.DIRECTIONS[direction], self.view[offset:offset + length]
+            offset += length
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+
+    def replay(self, connection: "Connection", realtime: bool = False) -> int:
+        """Feeds every record through the processing of connection, as if it arrived at the recorded time.
+
+        Returns the number of bytes processed. With realtime, waits between records as long as it originally took."""
+        framers = {x: XivBundleFramer() for x in SessionCapture.DIRECTIONS}
+        process_fns = {"S2D": connection.source_to_destination, "D2S": connection.destination_to_source}
+        started_at = first_timestamp = None
+        processed = 0
+        for timestamp, direction, data in self:
+            if first_timestamp is None:
+                started_at, first_timestamp = time.monotonic_ns(), timestamp
+            elif realtime:
+                delay = (timestamp - first_timestamp) - (time.monotonic_ns() - started_at)
+                if delay > 0:
+                    time.sleep(delay / 1e9)
+
+            framer = framers[direction]
+            # What fits in the buffer can change after each chunk, as writable compacts it.
+            offset = 0
+            while offset < len(data):
+                buffer = framer.writable()
+                chunk = data[offset:offset + len(buffer)]
+                buffer[:len(chunk)] = chunk
+                connection.commit_received(framer, len(chunk), direction, timestamp)
+                connection.process_received(framer, process_fns[direction], direction)
+                offset += len(chunk)
+            processed += len(data)
+        return processed
 
 
 class Connection:
     CAST_SENTINEL = None
+    SPLICE_SIZE: typing.ClassVar[int] = 65536
+    # How long to keep trying to write out what is left for a side, after the other side closed.
+    CLOSE_TIMEOUT: typing.ClassVar[float] = 60.
+    CONNECT_TIMEOUT: typing.ClassVar[float] = 3.
+    TCP_QUICKACK: typing.ClassVar[typing.Optional[int]] = getattr(socket, "TCP_QUICKACK", None)
+    IOV_MAX: typing.ClassVar[int] = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+    TIMESPEC: typing.ClassVar[struct.Struct] = struct.Struct("@ll")
+    TIMESTAMP_ANCBUFSIZE: typing.ClassVar[int] = \
+        socket.CMSG_SPACE(TIMESPEC.size) if hasattr(socket, "CMSG_SPACE") else 0
 
     all_connections: typing.ClassVar["Connection"] = list()
-
-    def __init__(self, sock: socket.socket, source: typing.Tuple[str, int]):
+    # Directory to record sessions of game connections into.
+    capture_dir: typing.ClassVar[typing.Optional[str]] = None
+    # Tells apart captures of connections that got the same file descriptor within the same microsecond.
+    capture_counter: typing.ClassVar[typing.Iterator[int]] = itertools.count()
+    # Sizes of kernel buffers of both sockets of every connection; 0 leaves them to the system.
+    socket_rcvbuf: typing.ClassVar[int] = 0
+    socket_sndbuf: typing.ClassVar[int] = 0
+
+    def __init__(self, sock: typing.Optional[socket.socket], source: typing.Optional[typing.Tuple[str, int]],
+                 destination: typing.Optional[typing.Tuple[str, int]] = None, region: typing.Optional[str] = None,
+                 log_sink: typing.Optional[typing.Callable[[str, typing.Dict[str, typing.Any]], None]] = None):
+        """Destination defaults to where the client originally tried to connect to before being redirected, and
+        region defaults to what the destination belongs to. Specify both to use without iptables.
+
+        Without sock, the connection can only be fed data directly, such as when replaying a captured session.
+        If log_sink is given, it is called with the event and fields of every record instead of logging it."""
         self.source = source
         self.socket = sock
 
-        self.conn_id = self.socket.fileno()
-        srv_port, srv_ip = struct.unpack("!2xH4s8x", self.socket.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, 16))
-        self.destination = (socket.inet_ntoa(srv_ip), srv_port)
-        self.remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.conn_id = self.socket.fileno() if sock is not None else 0
+        self.log_sink = log_sink
+        self.log_rate_limiter = log_writer.create_rate_limiter()
+        self.stats = ConnectionStats()
+        if destination is None:
+            srv_port, srv_ip = struct.unpack("!2xH4s8x", self.socket.getsockopt(socket.SOL_IP, SO_ORIGINAL_DST, 16))
+            destination = (socket.inet_ntoa(srv_ip), srv_port)
+        self.destination = destination
+        self.remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM) if sock is not None else None
+        self.capture: typing.Optional[SessionCapture] = None
+
+        self.accepted_at: typing.Optional[int] = time.perf_counter_ns()
+        self.connect_started_at: typing.Optional[int] = None
+        self.connect_result = 0
+        self.connected_event = threading.Event()
+        self.is_connected = False
 
         self.broken_event = threading.Event()
 
         self.pending_action_request_timestamps = collections.deque()
         self.last_animation_lock_ends_at = 0
 
-        self.is_game_connection = True
-
-        # See: https://github.com/ravahn/machina/tree/NetworkStructs/Machina.FFXIV/Headers/Opcodes
-        if any(ipaddress.ip_address(self.destination[0]) in x for x in INTL_DATACENTER_IP_NETWORK):
-            self.SUBTYPE_RESPONSE_ACTOR_CAST = 0x02b2
-            self.SUBTYPE_RESPONSE_ACTOR_CONTROL = 0x00f0
-            self.SUBTYPE_RESPONSE_ACTOR_CONTROL_SELF = 0x017a
-            self.SUBTYPE_RESPONSE_ACTION_RESULT = [0x021f, 0x03df, 0x00ad, 0x0229, 0x0197]
-
-            self.SUBTYPE_REQUEST_ACTION = 0x017a
-
-            self.log(f"New[INTL]:", self.socket.getsockname(), self.socket.getpeername(), self.destination)
-
-        elif any(ipaddress.ip_address(self.destination[0]) in x for x in KR_DATACENTER_IP_NETWORK):
-            self.SUBTYPE_RESPONSE_ACTOR_CAST = 0x03b8
-            self.SUBTYPE_RESPONSE_ACTOR_CONTROL = 0x013d
-            self.SUBTYPE_RESPONSE_ACTOR_CONTROL_SELF = 0x025f
-            self.SUBTYPE_RESPONSE_ACTION_RESULT = [0x0266, 0x0167, 0x03a7, 0x016b, 0x0231]
+        if region is None:
+            region = DATACENTER_INDEX.lookup(self.destination[0]) or "-"
+        self.profile = REGION_PROFILES.get(region)
+        self.is_game_connection = self.profile is not None
+        if self.is_game_connection:
+            self.request_handlers, self.response_handlers = Connection.dispatch_tables(self.profile)
+
+        self.region = region
+        if sock is None:
+            self.accepted_at = None
+            return
+        self.tune_socket(sock)
+
+        self.log(LOG_INFO, "new", "New[{region}]: {local} {peer} {destination}", region=region,
+                 local=self.socket.getsockname(), peer=self.socket.getpeername(), destination=self.destination)
+
+        if self.is_game_connection and Connection.capture_dir is not None:
+            name = (f"{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{os.getpid()}-{next(Connection.capture_counter)}-"
+                    f"{self.conn_id}.xivcap")
+            path = os.path.join(Connection.capture_dir, name)
+            try:
+                self.capture = SessionCapture(path, self.destination, region)
+            except OSError as e:
+                self.log(LOG_ERROR, "capture_failed", "Failed to open capture file {path}: {error}", path=path,
+                         error=str(e))
+
+    @staticmethod
+    def tune_socket(sock: socket.socket):
+        """Disables delays meant to save bandwidth, and sets kernel buffer sizes if specified."""
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if Connection.TCP_QUICKACK is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, Connection.TCP_QUICKACK, 1)
+        if Connection.socket_rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, Connection.socket_rcvbuf)
+        if Connection.socket_sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, Connection.socket_sndbuf)
+
+    def begin_connect(self):
+        """Starts connecting to destination without waiting, so that the handshake overlaps with setting up relaying.
+
+        Meant to be called right after accepting; run and run_async call this if it has not been called."""
+        self.tune_socket(self.remote)
+        self.remote.setblocking(False)
+        self.connect_started_at = time.perf_counter_ns()
+        self.connect_result = self.remote.connect_ex(self.destination)
+
+    def _finish_connect(self, ready: bool) -> bool:
+        if not ready:
+            error = errno.ETIMEDOUT
+        elif self.connect_result not in (0, errno.EINPROGRESS, errno.EAGAIN):
+            error = self.connect_result
+        else:
+            error = self.remote.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.log(LOG_WARNING, "connect_failed", "Failed to connect to {destination}: {error}",
+                     destination=self.destination, error=os.strerror(error))
+        else:
+            self.stats.handshake.record(time.perf_counter_ns() - self.connect_started_at)
+            self.is_connected = True
+        self.connected_event.set()
+        return self.is_connected
+
+    def finish_connect(self) -> bool:
+        """Waits for the connection begun by begin_connect, and tells whether it succeeded."""
+        poller = select.poll()
+        poller.register(self.remote, select.POLLOUT)
+        ready = bool(poller.poll(self.__class__.CONNECT_TIMEOUT * 1000))
+        self.remote.settimeout(60)
+        return self._finish_connect(ready)
+
+    async def finish_connect_async(self) -> bool:
+        loop = asyncio.get_running_loop()
+        writable = loop.create_future()
+        loop.add_writer(self.remote, lambda: writable.done() or writable.set_result(None))
+        try:
+            await asyncio.wait_for(writable, self.__class__.CONNECT_TIMEOUT)
+            ready = True
+        except asyncio.TimeoutError:
+            ready = False
+        finally:
+            loop.remove_writer(self.remote)
+        return self._finish_connect(ready)
+
+    def send_upstream(self, buffers: typing.List[typing.Union[bytes, memoryview]]):
+        """Sends to the server once connected, for reading from the client to start while connecting."""
+        if not self.is_connected:
+            self.connected_event.wait()
+            if not self.is_connected:
+                raise ConnectionError
+        self.send_vectored(self.remote, buffers)
+        if self.accepted_at is not None and any(buffers):
+            self.record_first_byte()
+
+    def record_first_byte(self):
+        self.stats.first_byte.record(time.perf_counter_ns() - self.accepted_at)
+        self.accepted_at = None
+
+    def commit_received(self, framer: XivBundleFramer, length: int, log_prefix: str, received_at: int):
+        """Makes length bytes written past the end of framer available, which arrived at received_at nanoseconds
+        since epoch."""
+        capture = self.capture
+        if capture is not None:
+            try:
+                capture.record(log_prefix, framer.view[framer.end:framer.end + length], received_at)
+            except OSError as e:
+                # Losing the capture is better than losing the session it was meant to help debug.
+                self.close_capture(e)
+        framer.commit(length, received_at / 1e9)
+        self.stats.directions[log_prefix].bytes += length
+
+    def close_capture(self, error: typing.Optional[OSError] = None):
+        """Stops capturing this connection, logging error or whatever closing the file raised."""
+        capture, self.capture = self.capture, None
+        if capture is None:
+            return
+        try:
+            capture.close()
+        except OSError as e:
+            error = error or e
+        if error is not None:
+            self.log(LOG_ERROR, "capture_failed", "Stopped capturing: {error}", error=str(error))
+
+    def process_received(self, framer: XivBundleFramer, process_fn: typing.Callable[[XivBundle], XivBundle],
+                         log_prefix: str) -> typing.List[typing.Union[bytes, memoryview]]:
+        """Returns what should be sent to the other side for the data newly committed to framer."""
+        if not self.is_game_connection:
+            return [framer.take()]
+
+        stats = self.stats.directions[log_prefix]
+
+        # Unmodified bundles and discarded fragments are forwarded as they came in, so consecutive runs of them are
+        # sent as a single slice of the receive buffer.
+        res = []
+        clean_begin = position = framer.begin
+        parse_started_at = time.perf_counter_ns()
+        for bundle in framer:
+            if type(bundle) is memoryview:
+                self.log(LOG_WARNING, "discarded", "{direction} discarded {length} bytes: {data}",
+                         direction=log_prefix, length=len(bundle), data=bytes(bundle[:LOG_DISCARDED_BYTES]))
+                position += len(bundle)
+                parse_started_at = time.perf_counter_ns()
+                continue
 
-            self.SUBTYPE_REQUEST_ACTION = 0x00f0
+            process_started_at = time.perf_counter_ns()
+            stats.parse.record(process_started_at - parse_started_at)
+            stats.bundles += 1
 
-            self.log(f"New[KR]:", self.socket.getsockname(), self.socket.getpeername(), self.destination)
-        else:
-            self.is_game_connection = False
-            self.log(f"New[-]:", self.socket.getsockname(), self.socket.getpeername(), self.destination)
+            length = bundle.length
+            try:
+                bundle = process_fn(bundle)
+            except InvalidDataException:
+                self.log(LOG_WARNING, "invalid", "{direction} forwarding bundle with invalid messages: {bundle}",
+                         direction=log_prefix, bundle=bytes(bundle.to_wire()[:LOG_DISCARDED_BYTES]))
+            stats.process.record(time.perf_counter_ns() - process_started_at)
+            if bundle.decompress_ns:
+                stats.decompress.record(bundle.decompress_ns)
+            if bundle.dirty:
+                if clean_begin != position:
+                    res.append(framer.view[clean_begin:position])
+                res.append(bundle.to_wire())
+                if bundle.compress_ns:
+                    stats.compress.record(bundle.compress_ns)
+                clean_begin = position + length
+            position += length
+            parse_started_at = time.perf_counter_ns()
+
+        if clean_begin != position:
+            res.append(framer.view[clean_begin:position])
+        return res
 
     def relay(self, read_fn, write_fn, process_fn: typing.Callable[[XivBundle], XivBundle], log_prefix: str):
+        framer = XivBundleFramer()
+        stats = self.stats.directions[log_prefix]
         try:
-            buffer = b""
-            more = True
-            while more:
+            while True:
                 try:
-                    data = read_fn(65536)
+                    length, arrived_at = read_fn(framer.writable())
                 except (ConnectionError, socket.timeout, OSError):
                     break
-                buffer += data
-                if not data:
-                    more = False
-                if self.is_game_connection:
-                    it = XivBundle.find(buffer)
-                    while True:
-                        try:
-                            bundle = next(it)
-                        except StopIteration as e:
-                            buffer = e.value
-                            break
-
-                        if type(bundle) is bytes:
-                            self.log(log_prefix, "discarded", " ".join(f"{x:02x}" for x in bundle))
-                            data = bundle
-                        else:
-                            bundle = process_fn(bundle)
-                            data = bytes(bundle)
-                        try:
-                            write_fn(data)
-                        except (ConnectionError, socket.timeout, OSError):
-                            break
-                else:
-                    write_fn(buffer)
-                    buffer = ""
-            if buffer:
+                if not length:
+                    break
+                received_at = time.perf_counter_ns()
+                self.commit_received(framer, length, log_prefix, arrived_at)
+
+                try:
+                    write_fn(self.process_received(framer, process_fn, log_prefix))
+                except (ConnectionError, socket.timeout, OSError):
+                    return
+                stats.dwell.record(time.perf_counter_ns() - received_at)
+
+            remaining = framer.take()
+            if remaining:
                 try:
-                    write_fn(buffer)
+                    write_fn([remaining])
                 except (ConnectionError, socket.timeout, OSError):
                     pass
         finally:
             self.broken_event.set()
 
+    @staticmethod
+    def recv_timestamped(sock: socket.socket, buffer: memoryview, quickack: bool = False) -> typing.Tuple[int, int]:
+        """Reads into buffer, and returns the number of bytes read and when they arrived in nanoseconds since epoch.
+
+        Arrival time is taken from the kernel if SO_TIMESTAMPNS is enabled on sock, and is now otherwise.
+        If quickack is set, TCP_QUICKACK is enabled again after reading."""
+        length, ancdata, _, _ = sock.recvmsg_into([buffer], Connection.TIMESTAMP_ANCBUFSIZE)
+        if quickack:
+            # Kernel turns this off again from time to time.
+            sock.setsockopt(socket.IPPROTO_TCP, Connection.TCP_QUICKACK, 1)
+        for level, kind, data in ancdata:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= Connection.TIMESPEC.size:
+                seconds, nanoseconds = Connection.TIMESPEC.unpack_from(data)
+                return length, seconds * 1000000000 + nanoseconds
+        return length, time.time_ns()
+
+    @staticmethod
+    def send_vectored(sock: socket.socket, buffers: typing.List[typing.Union[bytes, memoryview]]):
+        """Sends all buffers using as few sendmsg calls as possible, resuming after partial sends.
+
+        Blocks (up to the socket timeout) while the peer is not accepting data, which in turn stops the caller from
+        reading more from the other side."""
+        buffers = [memoryview(x) for x in buffers if x]
+        i = 0
+        while i < len(buffers):
+            sent = sock.sendmsg(buffers[i:i + Connection.IOV_MAX])
+            while sent:
+                if sent >= len(buffers[i]):
+                    sent -= len(buffers[i])
+                    i += 1
+                else:
+                    buffers[i] = buffers[i][sent:]
+                    sent = 0
+
+    @staticmethod
+    def wait_ready(sock: socket.socket, events: int) -> bool:
+        """Waits up to the timeout of sock for any of events, and tells whether one happened.
+
+        Uses poll, as select cannot wait on file descriptors past FD_SETSIZE."""
+        poller = select.poll()
+        poller.register(sock, events)
+        timeout = sock.gettimeout()
+        return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+    def relay_splice(self, source: socket.socket, destination: socket.socket):
+        """Relays data through a pipe using splice, so that it never has to be copied into Python."""
+        read_fd, write_fd = os.pipe()
+        try:
+            while True:
+                try:
+                    if not self.wait_ready(source, select.POLLIN):
+                        break
+                    length = os.splice(source.fileno(), write_fd, Connection.SPLICE_SIZE,
+                                       flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                except BlockingIOError:
+                    continue
+                except (OSError, ValueError):
+                    break
+                if not length:
+                    break
+
+                while length:
+                    try:
+                        if not self.wait_ready(destination, select.POLLOUT):
+                            return
+                        length -= os.splice(read_fd, destination.fileno(), length,
+                                            flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                    except BlockingIOError:
+                        continue
+                    except (OSError, ValueError):
+                        return
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+            self.broken_event.set()
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def dispatch_tables(cls, profile: RegionProfile) -> typing.Tuple[typing.Dict[int, typing.Callable],
+                                                                      typing.Dict[int, typing.Callable]]:
+        """Returns which handler to call for each IPC subtype sent to, and received from, servers of a region."""
+        requests = {profile.request_action: cls.on_action_request}
+        responses = {x: cls.on_action_effect for x in profile.response_action_result}
+        responses[profile.response_actor_control_self] = cls.on_actor_control_self
+        responses[profile.response_actor_control] = cls.on_actor_control
+        responses[profile.response_actor_cast] = cls.on_actor_cast
+        return requests, responses
+
     def source_to_destination(self, bundle: XivBundle):
+        handlers = self.request_handlers
+        if bundle.conn_type in self.profile.conn_types_without_ipc or not bundle.may_contain_ipc(handlers):
+            return bundle
         for message in bundle.messages:
             if not message.segment_type == XivMessage.SEGMENT_TYPE_IPC:
                 continue
@@ -364,17 +1864,18 @@ class Connection:
                 ipc = XivMessageIpc(message.data, 0)
                 if ipc.type != XivMessageIpc.TYPE_INTERESTED:
                     continue
-                if ipc.subtype == self.SUBTYPE_REQUEST_ACTION:
-                    self.pending_action_request_timestamps.append(time.time())
-                    if len(self.pending_action_request_timestamps) == 1:
-                        self.last_animation_lock_ends_at = self.pending_action_request_timestamps[-1]
-                    action_id, = struct.unpack("I", ipc.data[4:8])
-                    self.log(f"Action request: action=0x{action_id:04x}")
+                handler = handlers.get(ipc.subtype)
+                if handler is not None:
+                    handler(self, bundle, ipc)
             except (InvalidDataException, IncompleteDataException):
                 continue
         return bundle
 
     def destination_to_source(self, bundle: XivBundle):
+        handlers = self.response_handlers
+        if bundle.conn_type in self.profile.conn_types_without_ipc or \
+                not bundle.may_contain_ipc(handlers, self_only=True):
+            return bundle
         for message in bundle.messages:
             if not message.segment_type == XivMessage.SEGMENT_TYPE_IPC:
                 continue
@@ -384,101 +1885,813 @@ class Connection:
                 ipc = XivMessageIpc(message.data, 0)
                 if ipc.type != XivMessageIpc.TYPE_INTERESTED:
                     continue
-                if ipc.subtype in self.SUBTYPE_RESPONSE_ACTION_RESULT:
-                    effect = XivMessageIpcActionEffect(ipc.data, 0)
-                    new_duration = effect.animation_lock_duration
+                handler = handlers.get(ipc.subtype)
+                if handler is not None:
+                    handler(self, bundle, ipc)
+            except (InvalidDataException, IncompleteDataException):
+                continue
+        return bundle
 
-                    if self.pending_action_request_timestamps and effect.action_id != ACTION_ID_AUTO_ATTACK:
-                        if self.pending_action_request_timestamps[0] != Connection.CAST_SENTINEL:
-                            extra_delay = EXTRA_DELAY
-                            if extra_delay <= 7 * 0.01:
-                                # I told you to not decrease the value below 70ms.
-                                if random.randint(0, 9999) < 50:
-                                    # This is what you get for decreasing the value.
-                                    extra_delay = 5
-                            delay = max(0., extra_delay + new_duration)
-                            self.last_animation_lock_ends_at += delay
-                            new_duration = max(0., self.last_animation_lock_ends_at - time.time())
-                        self.pending_action_request_timestamps.popleft()
+    def on_action_request(self, bundle: XivBundle, ipc: XivMessageIpc):
+        self.pending_action_request_timestamps.append(bundle.received_at)
+        if len(self.pending_action_request_timestamps) == 1:
+            self.last_animation_lock_ends_at = self.pending_action_request_timestamps[-1]
+        action_id, = struct.unpack("I", ipc.data[4:8])
+        self.log(LOG_INFO, "action_request", "Action request: action=0x{action_id:04x}", action_id=action_id)
+
+    def on_action_effect(self, bundle: XivBundle, ipc: XivMessageIpc):
+        effect = XivMessageIpcActionEffect(ipc.data, 0)
+        new_duration = effect.animation_lock_duration
+        response_time = None
+
+        if self.pending_action_request_timestamps and effect.action_id != ACTION_ID_AUTO_ATTACK:
+            if self.pending_action_request_timestamps[0] != Connection.CAST_SENTINEL:
+                now = bundle.received_at
+                response_time = now - self.pending_action_request_timestamps[0]
+                self.stats.action_rtt.record(int(response_time * 1e9))
+                extra_delay = EXTRA_DELAY
+                if extra_delay <= 7 * 0.01:
+                    # I told you to not decrease the value below 70ms.
+                    if random.randint(0, 9999) < 50:
+                        # This is what you get for decreasing the value.
+                        extra_delay = 5
+                delay = max(0., extra_delay + new_duration)
+                self.last_animation_lock_ends_at += delay
+                new_duration = max(0., self.last_animation_lock_ends_at - now)
+            self.pending_action_request_timestamps.popleft()
+
+        self.log(LOG_INFO, "action_response",
+                 "Action response: action=0x{action_id:04x} delay={original:.3f} -> {rewritten:.3f}",
+                 action_id=effect.action_id, original=effect.animation_lock_duration,
+                 rewritten=new_duration, response_time=response_time)
+
+        if effect.animation_lock_duration != new_duration:
+            effect.animation_lock_duration = new_duration
+            bundle.dirty = True
+
+    def on_actor_control_self(self, bundle: XivBundle, ipc: XivMessageIpc):
+        control = XivMessageIpcActorControlSelf(ipc.data, 0)
+        if control.category == XivMessageIpcActorControlSelf.CATEGORY_ROLLBACK:
+
+            if self.pending_action_request_timestamps:
+                self.pending_action_request_timestamps.popleft()
+
+            self.log(LOG_INFO, "action_rollback", "Action rollback: action=0x{action_id:04x}",
+                     action_id=control.param_3)
+
+    def on_actor_control(self, bundle: XivBundle, ipc: XivMessageIpc):
+        control = XivMessageIpcActorControl(ipc.data, 0)
+        if control.category == XivMessageIpcActorControl.CATEGORY_CANCEL_CAST:
+            if self.pending_action_request_timestamps:
+                self.pending_action_request_timestamps.popleft()
+
+            self.log(LOG_INFO, "cast_cancel", "Cast cancel: action=0x{action_id:04x}",
+                     action_id=control.param_3)
+
+    def on_actor_cast(self, bundle: XivBundle, ipc: XivMessageIpc):
+        cast = XivMessageIpcActorCast(ipc.data, 0)
+
+        # Mark that the last request was a cast.
+        # If it indeed is a cast, the game UI will block the user from generating additional requests,
+        # so first item is guaranteed to be the cast action.
+        if self.pending_action_request_timestamps:
+            self.pending_action_request_timestamps[0] = Connection.CAST_SENTINEL
+
+        self.log(LOG_INFO, "cast", "Cast: action=0x{action_id:04x} time={cast_time:.3f}",
+                 action_id=cast.action_id, cast_time=cast.cast_time)
 
-                    self.log(f"Action response: action=0x{effect.action_id:04x} "
-                             f"delay={effect.animation_lock_duration:.3f} -> {new_duration:.3f}")
+    def run(self):
+        threads = []
+        try:
+            if self.connect_started_at is None:
+                self.begin_connect()
+
+            if not self.is_game_connection and hasattr(os, "splice"):
+                if not self.finish_connect():
+                    return
+                threads.append(threading.Thread(target=self.relay_splice, args=(self.socket, self.remote)))
+                threads.append(threading.Thread(target=self.relay_splice, args=(self.remote, self.socket)))
+                for x in threads:
+                    x.start()
+            else:
+                for sock in (self.socket, self.remote):
+                    try:
+                        sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+                    except OSError:
+                        pass
+                # Data from the client is read and processed while connecting, and sent once connected.
+                threads.append(threading.Thread(target=self.relay, args=(
+                    functools.partial(self.recv_timestamped, self.socket, quickack=self.TCP_QUICKACK is not None),
+                    self.send_upstream,
+                    self.source_to_destination, "S2D")))
+                threads[-1].start()
+                if not self.finish_connect():
+                    return
+                threads.append(threading.Thread(target=self.relay, args=(
+                    functools.partial(self.recv_timestamped, self.remote, quickack=self.TCP_QUICKACK is not None),
+                    functools.partial(self.send_vectored, self.socket),
+                    self.destination_to_source, "D2S")))
+                threads[-1].start()
+            self.broken_event.wait()
+        finally:
+            self.connected_event.set()
+            # Closing alone does not wake up threads blocked reading.
+            for sock in (self.remote, self.socket):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.remote.close()
+            self.socket.close()
+            for x in threads:
+                x.join()
+            self.close_capture()
+            self.log(LOG_INFO, "closed", "Closed")
+            stats_registry.retire(self)
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        protocols: typing.Tuple[RelayProtocol, ...] = ()
+        pumps = []
+        try:
+            if self.connect_started_at is None:
+                self.begin_connect()
+            self.socket.setblocking(False)
+            use_splice = not self.is_game_connection and hasattr(os, "splice")
+            if not use_splice:
+                # Spliced connections never look at the data, so they are spared the receive buffers.
+                s2d = RelayProtocol(self, self.source_to_destination, "S2D")
+                d2s = RelayProtocol(self, self.destination_to_source, "D2S")
+                s2d.peer, d2s.peer = d2s, s2d
+                protocols = (s2d, d2s)
+                # Data from the client is read and processed while connecting, and sent once connected.
+                await loop.connect_accepted_socket(lambda: s2d, self.socket)
+            if not await self.finish_connect_async():
+                return
 
-                    effect.animation_lock_duration = new_duration
+            if use_splice:
+                pumps.append(SplicePump(self.socket, self.remote))
+                pumps.append(SplicePump(self.remote, self.socket))
+                await asyncio.wait([x.closed for x in pumps], return_when=asyncio.FIRST_COMPLETED)
+                return
 
-                    effect_bytes = bytes(effect)
-                    ipc.data = effect_bytes + ipc.data[len(effect_bytes):]
-                    ipc_bytes = bytes(ipc)
-                    message.data = ipc_bytes + message.data[len(ipc_bytes):]
+            await loop.create_connection(lambda: d2s, sock=self.remote)
+            await asyncio.wait([s2d.closed, d2s.closed], return_when=asyncio.FIRST_COMPLETED)
 
-                elif ipc.subtype == self.SUBTYPE_RESPONSE_ACTOR_CONTROL_SELF:
-                    control = XivMessageIpcActorControlSelf(ipc.data, 0)
-                    if control.category == XivMessageIpcActorControlSelf.CATEGORY_ROLLBACK:
+            # Transports close once they have written out what is left.
+            for protocol in (s2d, d2s):
+                protocol.transport.close()
+            await asyncio.wait([s2d.lost, d2s.lost], timeout=Connection.CLOSE_TIMEOUT)
+        finally:
+            for pump in pumps:
+                pump.close()
+            for protocol in protocols:
+                buffer_budget.release(protocol)
+                if protocol.transport is not None:
+                    protocol.transport.close()
+            self.remote.close()
+            self.socket.close()
+            self.close_capture()
+            self.log(LOG_INFO, "closed", "Closed")
+            stats_registry.retire(self)
+
+    def log(self, level: int, event: str, fmt: str, **fields):
+        """Queues a record to be formatted later as fmt.format(**fields), on the log writer thread."""
+        if self.log_sink is not None:
+            self.log_sink(event, fields)
+            return
+        limiter = self.log_rate_limiter
+        printed = level >= log_writer.level and (limiter is None or limiter.allow())
+        if printed and limiter is not None and limiter.denied:
+            log_writer.put(True, LOG_WARNING, self.conn_id, "suppressed", "Suppressed {count} log lines",
+                           dict(count=limiter.denied))
+            limiter.denied = 0
+        if printed or log_writer.file is not None:
+            log_writer.put(printed, level, self.conn_id, event, fmt, fields)
+
+
+class RuntimeProfiler:
+    """Profiles processing of received data for a while, without restarting or dropping any connection.
+
+    While profiling, ENTRY_POINTS are replaced with wrappers that run them under cProfile, which then covers everything
+    they call; otherwise nothing is wrapped, so there is no cost at all. A profile can only follow one thread at a time,
+    so wrapped calls from different connections take turns."""
+
+    # Called by both engines and by replay for every read, so that parsing and processing is profiled wherever it runs.
+    ENTRY_POINTS: typing.ClassVar[typing.Tuple[typing.Tuple[type, str], ...]] = ((Connection, "process_received"),)
+    # Listed first in the summary with their call counts and times, whether called or not.
+    SUMMARY_FUNCTIONS: typing.ClassVar[typing.Tuple[typing.Callable, ...]] = (
+        Connection.process_received,
+        XivBundleFramer.__iter__,
+        XivBundle.find,
+        XivBundle.__init__,
+        XivBundle.messages.fget,
+        XivBundle.may_contain_ipc,
+        XivBundle.to_wire,
+        XivBundle.__bytes__,
+        Connection.source_to_destination,
+        Connection.destination_to_source,
+    )
+    # Number of heaviest functions by cumulative time listed after those.
+    SUMMARY_TOP: typing.ClassVar[int] = 40
+    MAX_SECONDS: typing.ClassVar[float] = 3600.
+
+    def __init__(self, output_dir: str = PROFILE_DIR, seconds: float = 30.):
+        self.output_dir = output_dir
+        self.seconds = seconds
+        # Held from start until results are written.
+        self.running = threading.Lock()
+        # Held while a wrapped call is being profiled.
+        self.lock = threading.Lock()
+        self.profile: typing.Optional[cProfile.Profile] = None
+        self.path = ""
+        self.started_at = 0.
+        self.originals: typing.List[typing.Tuple[type, str, typing.Callable]] = []
+
+    def start(self, seconds: typing.Optional[float] = None) -> typing.Optional[str]:
+        """Starts profiling for seconds, or for the default duration, and returns where results will be written to
+        without extension, or None if already profiling.
+
+        Logs, so it must not be called from a signal handler; register it with signal_dispatcher instead."""
+        if not self.running.acquire(blocking=False):
+            return None
+        seconds = self.seconds if seconds is None else seconds
+        self.profile = cProfile.Profile()
+        self.path = os.path.join(self.output_dir,
+                                 f"mitigate-profile-{os.getpid()}-{datetime.datetime.now():%Y%m%d-%H%M%S-%f}")
+        self.started_at = time.perf_counter()
+        for owner, name in self.__class__.ENTRY_POINTS:
+            original = owner.__dict__[name]
+            self.originals.append((owner, name, original))
+            setattr(owner, name, self._wrap(original, self.profile))
+        timer = threading.Timer(seconds, self.stop)
+        timer.daemon = True
+        timer.start()
+        log_process_event(LOG_INFO, "profile_started", "Profiling for {seconds:g}s into {path}.pstats", seconds=seconds,
+                          path=self.path)
+        return self.path
+
+    def stop(self):
+        """Puts back what was wrapped, and writes out the profile and its summary."""
+        for owner, name, original in self.originals:
+            setattr(owner, name, original)
+        self.originals = []
+        # Waits for a call that started before the wrappers were removed.
+        with self.lock:
+            profile, self.profile = self.profile, None
+        try:
+            # Names are predictable, so nothing that already exists under them is written to, such as a symlink
+            # planted in a shared directory.
+            os.makedirs(self.output_dir, mode=0o700, exist_ok=True)
+            profile.create_stats()
+            with open(self.path + ".pstats", "xb") as fp:
+                marshal.dump(profile.stats, fp)
+            with open(self.path + ".txt", "x") as fp:
+                fp.write(self.summarize(profile, time.perf_counter() - self.started_at))
+            log_process_event(LOG_INFO, "profile_written", "Profile written to {path}.pstats, summary to {path}.txt",
+                              path=self.path)
+        except OSError as e:
+            log_process_event(LOG_ERROR, "profile_failed", "Failed to write profile to {path}: {error}", path=self.path,
+                              error=str(e))
+        finally:
+            self.running.release()
 
-                        if self.pending_action_request_timestamps:
-                            self.pending_action_request_timestamps.popleft()
+    def _wrap(self, function: typing.Callable, profile: cProfile.Profile) -> typing.Callable:
+        lock = self.lock
 
-                        self.log(f"Action rollback: action=0x{control.param_3:04x}")
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with lock:
+                profile.enable()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    profile.disable()
 
-                elif ipc.subtype == self.SUBTYPE_RESPONSE_ACTOR_CONTROL:
-                    control = XivMessageIpcActorControl(ipc.data, 0)
-                    if control.category == XivMessageIpcActorControl.CATEGORY_CANCEL_CAST:
-                        if self.pending_action_request_timestamps:
-                            self.pending_action_request_timestamps.popleft()
+        return wrapper
 
-                        self.log(f"Cast cancel: action=0x{control.param_3:04x}")
+    @classmethod
+    def summarize(cls, profile: cProfile.Profile, elapsed: float) -> str:
+        """Returns call counts and times of SUMMARY_FUNCTIONS, followed by a pstats listing of the heaviest ones.
+
+        Every time a generator such as find resumes counts as a call."""
+        profile.create_stats()
+        if not profile.stats:
+            return f"Profiled for {elapsed:.3f}s, but nothing was received\n"
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        lines = [f"Profiled for {elapsed:.3f}s",
+                 f"{'calls':>10} {'own ms':>10} {'total ms':>10} {'us/call':>9}  function"]
+        for function in cls.SUMMARY_FUNCTIONS:
+            code = function.__code__
+            _, calls, own, total, _ = stats.stats.get((code.co_filename, code.co_firstlineno, code.co_name),
+                                                      (0, 0, 0., 0., None))
+            per_call = total / calls * 1e6 if calls else 0.
+            lines.append(f"{calls:>10} {own * 1e3:>10.1f} {total * 1e3:>10.1f} {per_call:>9.2f}  "
+                         f"{function.__qualname__}")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(cls.SUMMARY_TOP)
+        return "\n".join(lines) + "\n\n" + stream.getvalue()
+
+
+runtime_profiler = RuntimeProfiler()
+
+
+async def serve_async(listener: socket.socket):
+    loop = asyncio.get_running_loop()
+    listener.setblocking(False)
+    tasks = set()
+    while True:
+        sock, source = await loop.sock_accept(listener)
+        connection = Connection(sock, source)
+        connection.begin_connect()
+        Connection.all_connections.append(connection)
+        task = loop.create_task(connection.run_async())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+def serve(listener: socket.socket, engine: str, use_uvloop: bool):
+    """Relays every connection accepted from listener using the given engine, until interrupted."""
+    if engine == "asyncio":
+        if use_uvloop:
+            try:
+                import uvloop
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            except ImportError:
+                print("uvloop is not installed; using the default event loop.")
+        try:
+            asyncio.run(serve_async(listener))
+        except KeyboardInterrupt:
+            pass
+    else:
+        threads: typing.List[threading.Thread] = []
+        while True:
+            try:
+                connection = Connection(*listener.accept())
+            except KeyboardInterrupt:
+                break
+            connection.begin_connect()
+            Connection.all_connections.append(connection)
+            threads = [x for x in threads if x.is_alive()]
+            threads.append(threading.Thread(target=connection.run))
+            threads[-1].start()
+        for x in list(Connection.all_connections):
+            x.broken_event.set()
+        for x in threads:
+            x.join()
 
-                elif ipc.subtype == self.SUBTYPE_RESPONSE_ACTOR_CAST:
-                    cast = XivMessageIpcActorCast(ipc.data, 0)
 
-                    # Mark that the last request was a cast.
-                    # If it indeed is a cast, the game UI will block the user from generating additional requests,
-                    # so first item is guaranteed to be the cast action.
-                    if self.pending_action_request_timestamps:
-                        self.pending_action_request_timestamps[0] = Connection.CAST_SENTINEL
+def serve_stats(port: int):
+    stats_server = http.server.ThreadingHTTPServer(("127.0.0.1", port), StatsRequestHandler)
+    threading.Thread(target=stats_server.serve_forever, daemon=True).start()
+    print(f"Serving statistics on http://127.0.0.1:{port}/metrics")
 
-                    self.log(f"Cast: action=0x{cast.action_id:04x}")
 
-            except (InvalidDataException, IncompleteDataException):
-                continue
-        return bundle
+def register_runtime_signals():
+    """Prints the statistics summary on SIGUSR1 and starts a profile on SIGUSR2, in a process that relays."""
+    if hasattr(signal, "SIGUSR1"):
+        signal_dispatcher.register(signal.SIGUSR1, lambda: print(stats_registry.render_summary(), flush=True))
+        signal_dispatcher.register(signal.SIGUSR2, runtime_profiler.start)
+
+
+class WorkerSupervisor:
+    """Keeps count worker processes running, forking a replacement whenever one exits before stop is requested.
+
+    Each worker calls run_fn with its index, from 0 to count - 1, and exits with what it returns."""
+
+    RESTART_DELAY: typing.ClassVar[float] = 1.
+    SIGNAL_DELAY: typing.ClassVar[float] = 0.5
+    STOP_TIMEOUT: typing.ClassVar[float] = 5.
+
+    def __init__(self, count: int, run_fn: typing.Callable[[int], int]):
+        self.count = count
+        self.run_fn = run_fn
+        self.workers: typing.Dict[int, int] = {}
+        self.started_at: typing.Dict[int, float] = {}
+
+    def spawn(self, index: int):
+        # Anything buffered would otherwise be written again by the child, so stop_thread flushes the log file. Other
+        # threads may still log while forking, but the writer stays stopped, so the child cannot inherit it in the
+        # middle of printing.
+        with log_writer.thread_lock:
+            log_writer.stop_thread()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+        if pid == 0:
+            log_writer.forget_file()
+            code = 1
+            try:
+                code = self.run_fn(index)
+            except KeyboardInterrupt:
+                code = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        self.workers[pid] = index
+        self.started_at[index] = time.monotonic()
+
+    def signal_all(self, signum: int):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def start(self):
+        for i in range(self.count):
+            self.spawn(i)
 
     def run(self):
-        self.remote.settimeout(3)
-        threads = []
+        """Restarts any worker that exits until interrupted, and then waits for all of them to exit."""
         try:
-            try:
-                self.remote.connect(self.destination)
-            except (ConnectionError, socket.timeout):
-                return
-            self.remote.settimeout(60)
-
-            threads.append(threading.Thread(target=self.relay, args=(self.socket.recv,
-                                                                     self.remote.send,
-                                                                     self.source_to_destination,
-                                                                     "S2D")))
-            threads.append(threading.Thread(target=self.relay, args=(self.remote.recv,
-                                                                     self.socket.send,
-                                                                     self.destination_to_source,
-                                                                     "D2S")))
-            for x in threads:
-                x.start()
-            self.broken_event.wait()
+            while True:
+                pid, status = os.wait()
+                index = self.workers.pop(pid, None)
+                if index is None:
+                    continue
+                print(f"Worker {index} exited with status {os.waitstatus_to_exitcode(status)}; restarting.")
+                if time.monotonic() - self.started_at[index] < self.__class__.RESTART_DELAY:
+                    time.sleep(self.__class__.RESTART_DELAY)
+                self.spawn(index)
+        except KeyboardInterrupt:
+            pass
         finally:
-            self.remote.close()
-            self.socket.close()
-            for x in threads:
-                x.join()
-            self.log("Closed")
-            Connection.all_connections.remove(self)
+            self.stop()
+
+    def stop(self):
+        """Waits for every worker to exit, killing those that take too long.
+
+        Workers in the same process group get interrupted along with us on Ctrl+C; the rest are asked to stop after
+        a moment."""
+        started_at = time.monotonic()
+        signalled = False
+        while self.workers:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                self.workers.pop(pid, None)
+                continue
+            elapsed = time.monotonic() - started_at
+            if elapsed > self.__class__.STOP_TIMEOUT:
+                self.signal_all(signal.SIGKILL)
+            elif not signalled and elapsed > self.__class__.SIGNAL_DELAY:
+                self.signal_all(signal.SIGTERM)
+                signalled = True
+            time.sleep(0.05)
 
-    def log(self, *msg):
-        with multithread_print_lock:
-            print(f"[{self.conn_id}]", datetime.datetime.now(), *msg)
+
+def replay_session(path: str, realtime: bool) -> int:
+    try:
+        session = SessionReplay(path)
+    except (OSError, ValueError) as e:
+        print(f"Failed to open {path}: {e}")
+        return -1
+    try:
+        connection = Connection(None, None, session.destination, session.region)
+        Connection.all_connections.append(connection)
+        started_at = time.perf_counter()
+        processed = session.replay(connection, realtime)
+        elapsed = time.perf_counter() - started_at
+        # Otherwise what the connection logged while replaying gets printed in the middle of the summary.
+        log_writer.drain()
+        print(stats_registry.render_summary())
+        print(f"Replayed {processed} bytes in {elapsed:.3f}s ({processed / elapsed / 1048576:.2f} MB/s)")
+        return 0
+    finally:
+        log_writer.close()
+        session.close()
+
+
+class ActionSummary(typing.NamedTuple):
+    """Statistics of one action, or of every action if action_id is None. Times are in seconds, and NaN if unknown."""
+
+    action_id: typing.Optional[int]
+    requests: int
+    responses: int
+    response_time_mean: float
+    response_time_p50: float
+    response_time_p90: float
+    response_time_p99: float
+    original_lock_mean: float
+    rewritten_lock_mean: float
+    rollbacks: int
+    cancels: int
+    casts: int
+
+
+class SessionAnalysis:
+    """Collects what Connection logs about actions from recorded sessions and --log-file logs, as one array per field,
+    and summarizes them per action.
+
+    Summaries are computed over whole arrays at once using numpy if it is installed, and one event at a time
+    otherwise."""
+
+    EVENTS: typing.ClassVar[typing.Dict[str, int]] = {
+        x: i for i, x in enumerate(("action_request", "action_response", "action_rollback", "cast_cancel", "cast"))}
+    EVENT_REQUEST, EVENT_RESPONSE, EVENT_ROLLBACK, EVENT_CANCEL, EVENT_CAST = range(5)
+    # Finds lines of interest in logs without decoding every line.
+    LOG_EVENT_PATTERN: typing.ClassVar[typing.Pattern] = re.compile(
+        r'"event": "(?:' + "|".join(EVENTS) + r')"')
+    PERCENTILES: typing.ClassVar[typing.Tuple[int, ...]] = (50, 90, 99)
+
+    def __init__(self):
+        self.events = array.array("B")
+        self.action_ids = array.array("I")
+        self.response_times = array.array("d")
+        self.original_locks = array.array("d")
+        self.rewritten_locks = array.array("d")
+        self.files = 0
+        # Sum of how long each file spans, in seconds.
+        self.duration = 0.
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event: str, fields: typing.Dict[str, typing.Any]):
+        response_time = fields.get("response_time")
+        self.events.append(self.__class__.EVENTS[event])
+        self.action_ids.append(fields["action_id"])
+        self.response_times.append(math.nan if response_time is None else response_time)
+        self.original_locks.append(fields.get("original", math.nan))
+        self.rewritten_locks.append(fields.get("rewritten", math.nan))
+
+    def add_file(self, path: str):
+        """Adds a file written by SessionCapture or LogWriter, telling which by its beginning."""
+        with open(path, "rb") as fp:
+            magic = fp.read(len(SessionCapture.MAGIC))
+        if magic == SessionCapture.MAGIC:
+            self.add_capture(path)
+        else:
+            self.add_log(path)
+        self.files += 1
+
+    def add_capture(self, path: str):
+        """Replays a recorded session, collecting what would have been logged about actions."""
+        session = SessionReplay(path)
+        try:
+            events = self.__class__.EVENTS
+
+            def collect(event: str, fields: typing.Dict[str, typing.Any]):
+                if event in events:
+                    self.add(event, fields)
+
+            connection = Connection(None, None, session.destination, session.region, log_sink=collect)
+            session.replay(connection)
+            timestamps = [x for x, _, _ in session]
+            if timestamps:
+                self.duration += (timestamps[-1] - timestamps[0]) / 1e9
+        finally:
+            session.close()
+
+    def add_log(self, path: str):
+        pattern = self.__class__.LOG_EVENT_PATTERN
+        first_time = last_time = None
+        line = ""
+        with open(path, "r", encoding="utf-8") as fp:
+            for line in fp:
+                if first_time is None or pattern.search(line) is not None:
+                    try:
+                        record = json.loads(line)
+                        if first_time is None:
+                            first_time = record["time"]
+                        last_time = record["time"]
+                        if record["event"] in self.__class__.EVENTS:
+                            self.add(record["event"], record)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        # Lines in between are skipped, so the last line tells when the log ends.
+        try:
+            last_time = json.loads(line)["time"]
+        except (ValueError, KeyError, TypeError):
+            pass
+        if first_time is not None:
+            self.duration += last_time - first_time
+
+    def summarize(self) -> typing.List[ActionSummary]:
+        """Returns statistics of every action, followed by statistics of each action by number of requests, then by
+        action id."""
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        summaries = []
+        for by_action in (False, True):
+            if numpy is not None:
+                group = self._summarize_numpy(numpy, by_action)
+            else:
+                group = self._summarize_python(by_action)
+            # Ties are broken by action, so that the order does not depend on which way was taken.
+            summaries.extend(sorted(group, key=lambda x: (-x.requests, x.action_id or 0)))
+        return summaries
+
+    def _summarize_numpy(self, numpy, by_action: bool) -> typing.List[ActionSummary]:
+        cls = self.__class__
+        events = numpy.frombuffer(self.events, numpy.uint8)
+        action_ids = numpy.frombuffer(self.action_ids, numpy.uint32)
+        response_times = numpy.frombuffer(self.response_times, numpy.float64)
+        original_locks = numpy.frombuffer(self.original_locks, numpy.float64)
+        rewritten_locks = numpy.frombuffer(self.rewritten_locks, numpy.float64)
+        if by_action:
+            keys, groups = numpy.unique(action_ids, return_inverse=True)
+            keys = keys.tolist()
+        else:
+            keys, groups = [None], numpy.zeros(len(events), numpy.intp)
+
+        def count(mask) -> numpy.ndarray:
+            return numpy.bincount(groups[mask], minlength=len(keys))
+
+        def mean(mask, values) -> numpy.ndarray:
+            with numpy.errstate(invalid="ignore", divide="ignore"):
+                return numpy.bincount(groups[mask], values[mask], len(keys)) / count(mask)
+
+        responses = events == cls.EVENT_RESPONSE
+        timed = responses & ~numpy.isnan(response_times)
+        # Sorted by action, then by response time, so that each action has a consecutive run of its response times.
+        timed_groups = groups[timed]
+        order = numpy.lexsort((response_times[timed], timed_groups))
+        sorted_times = response_times[timed][order]
+        timed_counts = count(timed)
+        starts = numpy.cumsum(timed_counts) - timed_counts
+        percentiles = []
+        for percent in cls.PERCENTILES:
+            if not len(sorted_times):
+                percentiles.append([math.nan] * len(keys))
+                continue
+            index = numpy.where(timed_counts > 0, starts + (timed_counts - 1) * percent // 100, 0)
+            percentiles.append(numpy.where(timed_counts > 0, sorted_times[index], math.nan).tolist())
+
+        columns = (count(events == cls.EVENT_REQUEST).tolist(), count(responses).tolist(),
+                   mean(timed, response_times).tolist(), *percentiles,
+                   mean(responses, original_locks).tolist(), mean(responses, rewritten_locks).tolist(),
+                   count(events == cls.EVENT_ROLLBACK).tolist(), count(events == cls.EVENT_CANCEL).tolist(),
+                   count(events == cls.EVENT_CAST).tolist())
+        return [ActionSummary(key, *row) for key, *row in zip(keys, *columns)]
+
+    def _summarize_python(self, by_action: bool) -> typing.List[ActionSummary]:
+        cls = self.__class__
+        counts = collections.defaultdict(lambda: [0] * len(cls.EVENTS))
+        times = collections.defaultdict(list)
+        lock_sums = collections.defaultdict(lambda: [0., 0.])
+        if not by_action:
+            counts[None] = [0] * len(cls.EVENTS)
+        for event, action_id, response_time, original, rewritten in zip(
+                self.events, self.action_ids, self.response_times, self.original_locks, self.rewritten_locks):
+            key = action_id if by_action else None
+            counts[key][event] += 1
+            if event == cls.EVENT_RESPONSE:
+                sums = lock_sums[key]
+                sums[0] += original
+                sums[1] += rewritten
+                if not math.isnan(response_time):
+                    times[key].append(response_time)
+
+        summaries = []
+        for key, row in counts.items():
+            responses = row[cls.EVENT_RESPONSE]
+            values = sorted(times[key])
+            percentiles = [values[(len(values) - 1) * x // 100] if values else math.nan for x in cls.PERCENTILES]
+            original, rewritten = (x / responses if responses else math.nan for x in lock_sums[key])
+            summaries.append(ActionSummary(
+                key, row[cls.EVENT_REQUEST], responses, sum(values) / len(values) if values else math.nan,
+                *percentiles, original, rewritten, row[cls.EVENT_ROLLBACK], row[cls.EVENT_CANCEL],
+                row[cls.EVENT_CAST]))
+        return summaries
+
+    @staticmethod
+    def render(summaries: typing.List[ActionSummary]) -> str:
+        def ms(value: float) -> str:
+            return "-" if math.isnan(value) else f"{value * 1e3:.1f}"
+
+        def ratio(count: int, total: int) -> str:
+            return f"{count / total:.1%}" if total else "-"
+
+        lines = [f"{'action':<8} {'requests':>9} {'responses':>9} {'rtt ms':>7} {'p50':>7} {'p90':>7} {'p99':>7} "
+                 f"{'lock ms':>8} {'-> new':>7} {'rollback':>8} {'cancel':>7} {'cast':>7}"]
+        for x in summaries:
+            lines.append(f"{'all' if x.action_id is None else f'0x{x.action_id:04x}':<8} {x.requests:>9} "
+                         f"{x.responses:>9} {ms(x.response_time_mean):>7} {ms(x.response_time_p50):>7} "
+                         f"{ms(x.response_time_p90):>7} {ms(x.response_time_p99):>7} "
+                         f"{ms(x.original_lock_mean):>8} {ms(x.rewritten_lock_mean):>7} "
+                         f"{ratio(x.rollbacks, x.requests):>8} {ratio(x.cancels, x.requests):>7} "
+                         f"{ratio(x.casts, x.requests):>7}")
+        return "\n".join(lines)
+
+
+def analyze_sessions(paths: typing.List[str]) -> int:
+    analysis = SessionAnalysis()
+    started_at = time.perf_counter()
+    try:
+        for path in paths:
+            try:
+                analysis.add_file(path)
+            except (OSError, ValueError) as e:
+                print(f"Failed to read {path}: {e}")
+                return -1
+    finally:
+        log_writer.close()
+    elapsed = time.perf_counter() - started_at
+    print(SessionAnalysis.render(analysis.summarize()))
+    print(f"Analyzed {len(analysis)} events spanning {analysis.duration / 3600:.2f}h from {analysis.files} files "
+          f"in {elapsed:.3f}s")
+    return 0
 
 
 def __main__() -> int:
+    parser = argparse.ArgumentParser(description="Mitigate animation lock delays caused by network latency.")
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread",
+                        help="relay connections using two threads per connection, or a single asyncio event loop")
+    parser.add_argument("--uvloop", action="store_true",
+                        help="use uvloop as the event loop for the asyncio engine, if it is installed")
+    parser.add_argument("--log-level", choices=LOG_LEVEL_NAMES.values(), default="info",
+                        help="minimum level of messages to print")
+    parser.add_argument("--log-rate", type=float, default=50.,
+                        help="maximum number of messages printed per second per connection; 0 to disable limiting")
+    parser.add_argument("--log-file", help="append every message to this file as JSON lines")
+    parser.add_argument("--stats-port", type=int,
+                        help="serve latency statistics in Prometheus text format on this port of localhost")
+    parser.add_argument("--capture-dir", help="record data of every game connection into a file in this directory")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="process a file recorded with --capture-dir as fast as possible, and exit")
+    parser.add_argument("--replay-realtime", action="store_true",
+                        help="with --replay, take as long between chunks of data as it originally did")
+    parser.add_argument("--analyze", metavar="FILE", nargs="+",
+                        help="print statistics of each action from recorded sessions and --log-file logs, then exit")
+    parser.add_argument("--datacenter-config", metavar="FILE",
+                        help="JSON object of region to list of networks to use instead of resolving them")
+    parser.add_argument("--datacenter-cache", metavar="FILE", default=DATACENTER_CACHE_PATH,
+                        help="where to keep resolved networks between runs (default: %(default)s)")
+    parser.add_argument("--buffer-limit", type=int, default=buffer_budget.per_direction, metavar="BYTES",
+                        help="with the asyncio engine, stop reading from a side while this much is waiting to be "
+                             "written to the other (default: %(default)s)")
+    parser.add_argument("--buffer-limit-total", type=int, default=buffer_budget.total, metavar="BYTES",
+                        help="with the asyncio engine, stop reading from whichever side writes more while this much "
+                             "is waiting to be written over all connections of a process (default: %(default)s)")
+    parser.add_argument("--rcvbuf", type=int, default=0, metavar="BYTES",
+                        help="kernel receive buffer size of both sockets of every connection (default: system default)")
+    parser.add_argument("--sndbuf", type=int, default=0, metavar="BYTES",
+                        help="kernel send buffer size of both sockets of every connection (default: system default)")
+    parser.add_argument("--profile-dir", metavar="DIR", default=runtime_profiler.output_dir,
+                        help="where to write profiles started by SIGUSR2 or by POST /profile?seconds=N to the "
+                             "statistics port (default: %(default)s)")
+    parser.add_argument("--profile-seconds", type=float, default=runtime_profiler.seconds, metavar="SECONDS",
+                        help="how long a profile started by SIGUSR2 lasts (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of processes relaying connections, sharing the listening port; "
+                             "with more than 1, statistics of each are served on consecutive ports from --stats-port")
+    args = parser.parse_args()
+
+    buffer_budget.per_direction = args.buffer_limit
+    buffer_budget.total = args.buffer_limit_total
+    Connection.socket_rcvbuf = args.rcvbuf
+    Connection.socket_sndbuf = args.sndbuf
+    runtime_profiler.output_dir = args.profile_dir
+    runtime_profiler.seconds = args.profile_seconds
+
+    global log_writer
+    new_log_writer = functools.partial(LogWriter, level={v: k for k, v in LOG_LEVEL_NAMES.items()}[args.log_level],
+                                       file_path=args.log_file, rate=args.log_rate, burst=args.log_rate * 4)
+    try:
+        log_writer = new_log_writer()
+    except OSError as e:
+        print(f"Failed to open {args.log_file}: {e}")
+        return -1
+
+    if args.replay:
+        return replay_session(args.replay, args.replay_realtime)
+    if args.analyze:
+        return analyze_sessions(args.analyze)
+
+    if args.capture_dir:
+        os.makedirs(args.capture_dir, mode=0o700, exist_ok=True)
+        Connection.capture_dir = args.capture_dir
+
+    try:
+        resolver = DatacenterResolver(args.datacenter_cache, config_path=args.datacenter_config)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read {args.datacenter_config}: {e}")
+        return -1
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("Multiple workers are not supported on this platform.")
+        return -1
+
+    # A stale cache is refreshed only once on_change can update the iptables rule, and, with workers, after the first
+    # ones are forked before any other thread starts, other than lookups that missed the resolution deadline.
+    # Workers restarted later are forked while the signal dispatcher, and possibly a refresh, run in this process;
+    # neither holds anything a worker uses, and WorkerSupervisor.spawn keeps the log writer stopped while forking.
+    resolver.start(background=False)
+    if not DATACENTER_INDEX:
+        print("Failed to find any datacenter; specify networks using --datacenter-config.")
+        return -1
+
     listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Buffer sizes have to be set before the handshake for the window to be scaled accordingly.
+    Connection.tune_socket(listener)
+    if args.workers > 1:
+        # Only reserves the port; each worker listens on its own socket, and the kernel spreads connections over them.
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     while True:
         port = random.randint(10000, 65535)
         try:
@@ -487,28 +2700,77 @@ def __main__() -> int:
             continue
         break
 
-    networks = ",".join(str(x) for x in INTL_DATACENTER_IP_NETWORK.union(KR_DATACENTER_IP_NETWORK))
+    networks = ",".join(str(x) for x in DATACENTER_INDEX.all_networks())
     if os.system(f"iptables -t nat -I PREROUTING -d {networks} -p tcp -j REDIRECT --to {port}"):
         print("This program requires root permissions.\n")
         return -1
     os.system("sysctl -w net.ipv4.ip_forward=1")
 
-    listener.listen(8)
-    print(f"Listening on {listener.getsockname()}...")
-    print("Press Ctrl+C to quit.")
+    def update_rule():
+        nonlocal networks
+        new_networks = ",".join(str(x) for x in DATACENTER_INDEX.all_networks())
+        if new_networks == networks:
+            return
+        if os.system(f"iptables -t nat -I PREROUTING -d {new_networks} -p tcp -j REDIRECT --to {port}"):
+            print("Failed to update iptables rule.")
+            return
+        os.system(f"iptables -t nat -D PREROUTING -d {networks} -p tcp -j REDIRECT --to-port {port}")
+        networks = new_networks
+
+    def run_worker(index: int) -> int:
+        global log_writer
+        try:
+            log_writer = new_log_writer()
+        except OSError as e:
+            print(f"Worker {index} failed to open {args.log_file}: {e}")
+            return -1
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        signal_dispatcher.register(signal.SIGHUP, resolver.reload)
+        worker_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        worker_listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        Connection.tune_socket(worker_listener)
+        worker_listener.bind(("0.0.0.0", port))
+        worker_listener.listen(8)
+        if args.stats_port:
+            serve_stats(args.stats_port + index)
+        register_runtime_signals()
+        print(f"Worker {index} listening on {worker_listener.getsockname()}...")
+        try:
+            serve(worker_listener, args.engine, args.uvloop)
+        finally:
+            log_writer.close()
+        return 0
+
     try:
-        while True:
-            try:
-                connection = Connection(*listener.accept())
-            except KeyboardInterrupt:
-                break
-            Connection.all_connections.append(connection)
-            threading.Thread(target=connection.run).start()
-        for x in list(Connection.all_connections):
-            x.broken_event.set()
-        for x in list(Connection.all_connections):
-            x.join()
+        if args.workers > 1:
+            supervisor = WorkerSupervisor(args.workers, run_worker)
+
+            def on_change():
+                update_rule()
+                supervisor.signal_all(signal.SIGHUP)
+
+            resolver.on_change = on_change
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            print(f"Starting {args.workers} workers on port {port}...")
+            print("Press Ctrl+C to quit.")
+            supervisor.start()
+            if hasattr(signal, "SIGUSR1"):
+                signal_dispatcher.register(signal.SIGUSR1, lambda: supervisor.signal_all(signal.SIGUSR1))
+                signal_dispatcher.register(signal.SIGUSR2, lambda: supervisor.signal_all(signal.SIGUSR2))
+            resolver.refresh_in_background()
+            supervisor.run()
+        else:
+            resolver.on_change = update_rule
+            resolver.refresh_in_background()
+            if args.stats_port:
+                serve_stats(args.stats_port)
+            register_runtime_signals()
+            listener.listen(8)
+            print(f"Listening on {listener.getsockname()}...")
+            print("Press Ctrl+C to quit.")
+            serve(listener, args.engine, args.uvloop)
     finally:
+        log_writer.close()
         if os.system(f"iptables -t nat -D PREROUTING -d {networks} -p tcp -j REDIRECT --to-port {port}"):
             print("Failed to remove iptables rule.")
             return -1
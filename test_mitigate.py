@@ -0,0 +1,625 @@
+#!/usr/bin/env python
+
+import ipaddress
+import json
+import math
+import os
+import random
+import tempfile
+import time
+import typing
+import unittest
+
+import benchmark
+import mitigate
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def find_all(data: bytes) -> typing.Tuple[typing.List[bytes], typing.List[bytes], bytes]:
+    """Returns bytes of bundles and of discarded fragments yielded by XivBundle.find, and of everything yielded
+    followed by what was left unconsumed."""
+    bundles, fragments, items = [], [], []
+    it = mitigate.XivBundle.find(bytearray(data), received_at=0.)
+    while True:
+        try:
+            item = next(it)
+        except StopIteration as e:
+            items.append(data[e.value:])
+            break
+        if type(item) is memoryview:
+            fragments.append(bytes(item))
+            items.append(fragments[-1])
+        else:
+            bundles.append(bytes(item.to_wire()))
+            items.append(bundles[-1])
+    return bundles, fragments, b"".join(items)
+
+
+def frame_in_chunks(rng: random.Random, data: bytes, received_at: float = 1.) -> typing.List[bytes]:
+    """Feeds data to a framer in random chunk sizes, as recv_into would, and returns bytes of what it yields."""
+    framer = mitigate.XivBundleFramer()
+    items = []
+    offset = 0
+    while offset < len(data):
+        buffer = framer.writable()
+        length = min(len(data) - offset, rng.randint(1, len(buffer)) if rng.random() < 0.1 else rng.randint(1, 300))
+        buffer[:length] = data[offset:offset + length]
+        offset += length
+        framer.commit(length, received_at)
+        for item in framer:
+            if type(item) is memoryview:
+                items.append(bytes(item))
+            else:
+                assert item.received_at == received_at
+                items.append(bytes(item.to_wire()))
+    items.append(bytes(framer.take()))
+    return items
+
+
+def make_connection() -> mitigate.Connection:
+    """Returns a connection to a server of INTL that only processes what it is given, collecting what it logs."""
+    connection = mitigate.Connection(None, None, ("127.0.0.1", 55006), "INTL",
+                                     log_sink=lambda event, fields: connection.logged.append((event, fields)))
+    connection.logged = []
+    return connection
+
+
+class TestFind(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(1)
+
+    def split_bundles(self, data: bytes) -> list:
+        bundles, fragments, _ = find_all(data)
+        self.assertFalse(fragments)
+        return bundles
+
+    def test_clean(self):
+        data = benchmark.make_stream(self.rng, 200, 0.5)
+        bundles, fragments, joined = find_all(data)
+        self.assertEqual(len(bundles), 200)
+        self.assertFalse(fragments)
+        self.assertEqual(joined, data)
+
+    def test_corrupted(self):
+        for ratio in (0.2, 1.):
+            data = benchmark.make_stream(self.rng, 200, 0.5)
+            corrupted = benchmark.corrupt(self.rng, data, ratio)
+            bundles, fragments, joined = find_all(corrupted)
+            self.assertEqual(bundles, self.split_bundles(data))
+            self.assertTrue(fragments)
+            self.assertEqual(joined, corrupted)
+
+    def test_garbage(self):
+        data = self.rng.randbytes(65536)
+        bundles, fragments, joined = find_all(data)
+        self.assertFalse(bundles)
+        self.assertEqual(joined, data)
+
+    def test_zeroes(self):
+        data = bytes(65536)
+        bundles, fragments, joined = find_all(data)
+        self.assertFalse(bundles)
+        # Zeroes too short for a header might be the beginning of one, so they are left for the next call.
+        self.assertEqual(len(b"".join(fragments)), len(data) - mitigate.XivBundle.DEFINITION.size + 1)
+        self.assertEqual(joined, data)
+
+        bundle = benchmark.make_bundle([benchmark.make_message(self.rng, 1, b"x" * 32)], False)
+        for zeroes in (1, 15, 16, 40, 4096):
+            data = bytes(zeroes) + bundle + bytes(zeroes) + bundle
+            bundles, fragments, joined = find_all(data)
+            self.assertEqual(bundles, [bundle, bundle])
+            self.assertEqual(joined, data)
+
+    def test_incomplete(self):
+        data = benchmark.make_stream(self.rng, 3, 0.5)
+        it = mitigate.XivBundle.find(bytearray(data), 0, len(data) - 1, received_at=0.)
+        bundles = []
+        while True:
+            try:
+                bundles.append(next(it))
+            except StopIteration as e:
+                offset = e.value
+                break
+        self.assertEqual(len(bundles), 2)
+        self.assertEqual(offset, sum(x.length for x in bundles))
+
+    def test_read_only(self):
+        data = benchmark.make_stream(self.rng, 1, 0.)
+        with self.assertRaises(TypeError):
+            list(mitigate.XivBundle.find(data, received_at=0.))
+        with self.assertRaises(TypeError):
+            mitigate.XivBundle(data, 0, 0.)
+
+
+class TestPlausibility(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(2)
+        self.messages = [benchmark.make_message(self.rng, 1, b"x" * 32) for _ in range(3)]
+
+    def make(self, compressed: bool = False, **fields) -> bytearray:
+        data = bytearray(benchmark.make_bundle(self.messages, compressed))
+        header = mitigate.XivBundle.header_of(data)
+        for name, value in fields.items():
+            setattr(header, name, value)
+        return data
+
+    def assertInvalid(self, data: bytearray):
+        with self.assertRaises(mitigate.InvalidDataException):
+            mitigate.XivBundle(data, 0, 0.)
+
+    def test_valid(self):
+        for compressed in (False, True):
+            bundle = mitigate.XivBundle(self.make(compressed), 0, 0.)
+            self.assertTrue(bundle.is_plausible())
+            self.assertTrue(bundle.has_plausible_messages())
+            self.assertEqual(len(bundle.messages), 3)
+
+    def test_length(self):
+        self.assertInvalid(self.make(length=mitigate.XivBundle.DEFINITION.size - 1))
+        self.assertInvalid(self.make(length=0))
+
+    def test_compression_flag(self):
+        self.assertInvalid(self.make(zlib_compressed=2))
+        # Uncompressed messages read as compressed do not start with a zlib header.
+        self.assertInvalid(self.make(zlib_compressed=1))
+
+    def test_message_count(self):
+        self.assertInvalid(self.make(message_count=100))
+        # Fits in length as far as is_plausible can tell, but the third message would run past the end.
+        data = self.make(message_count=4)
+        header = mitigate.XivBundle.header_of(data)
+        self.assertTrue(header.is_plausible())
+        self.assertInvalid(data)
+
+    def test_message_length(self):
+        data = self.make()
+        # Length of the first message, running past the end of the bundle.
+        offset = mitigate.XivBundle.DEFINITION.size
+        data[offset:offset + 4] = (1 << 20).to_bytes(4, "little")
+        self.assertInvalid(data)
+
+    def test_zlib_header(self):
+        # Compression method other than deflate.
+        data = self.make(True)
+        data[mitigate.XivBundle.DEFINITION.size] ^= 0x0f
+        self.assertInvalid(data)
+        # Preset dictionary, with the check value fixed up.
+        data = self.make(True)
+        offset = mitigate.XivBundle.DEFINITION.size
+        flags = data[offset + 1] & 0xe0 | 0x20
+        data[offset + 1] = flags + 31 - ((data[offset] << 8) | flags) % 31
+        self.assertInvalid(data)
+
+
+class TestFramer(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(3)
+
+    def test_clean(self):
+        data = benchmark.make_stream(self.rng, 300, 0.5)
+        items = frame_in_chunks(self.rng, data)
+        self.assertEqual(b"".join(items), data)
+        self.assertEqual([x for x in items if x], find_all(data)[0])
+
+    def test_corrupted(self):
+        data = benchmark.make_stream(self.rng, 300, 0.5)
+        corrupted = benchmark.corrupt(self.rng, data, 0.3)
+        items = frame_in_chunks(self.rng, corrupted)
+        self.assertEqual(b"".join(items), corrupted)
+        bundles = set(find_all(data)[0])
+        self.assertEqual([x for x in items if x in bundles], find_all(data)[0])
+
+    def test_need(self):
+        framer = mitigate.XivBundleFramer()
+        bundle = benchmark.make_bundle([benchmark.make_message(self.rng, 1, b"x" * 200)], False)
+        for i, x in enumerate(bundle[:-1]):
+            framer.writable()[0] = x
+            framer.commit(1, 0.)
+            self.assertFalse(list(framer))
+            if i + 1 >= mitigate.XivBundle.DEFINITION.size:
+                self.assertEqual(framer.need, len(bundle))
+        framer.writable()[0] = bundle[-1]
+        framer.commit(1, 0.)
+        self.assertEqual([bytes(x.to_wire()) for x in framer], [bundle])
+        self.assertEqual(framer.need, 0)
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(5)
+        self.values = [int(rng.lognormvariate(12, 3)) for _ in range(10000)] + [0, 1, 31, 32, 33]
+        self.histogram = mitigate.LatencyHistogram()
+        for x in self.values:
+            self.histogram.record(x)
+
+    def test_percentile(self):
+        values = sorted(self.values)
+        for percent in (1, 10, 50, 90, 99, 99.9, 100):
+            exact = values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+            actual = self.histogram.percentile(percent)
+            # Never below the exact value, and above it by at most the width of its bucket.
+            self.assertLessEqual(exact, actual)
+            self.assertLessEqual(actual, exact + exact / mitigate.LatencyHistogram._HALF + 1)
+        self.assertEqual(self.histogram.percentile(100), max(self.values))
+        self.assertEqual(mitigate.LatencyHistogram().percentile(50), 0)
+
+    def test_count_below(self):
+        bounds = [0, 1, 32, 1000, 10 ** 5, 10 ** 6, 12345678, 10 ** 9, 10 ** 12]
+        counts = self.histogram.counts_below(bounds)
+        self.assertEqual(counts, [self.histogram.count_below(x) for x in bounds])
+        for bound, count in zip(bounds, counts):
+            # Buckets straddling bound are left out, so only values well below it are certain to be counted.
+            self.assertLessEqual(count, sum(1 for x in self.values if x < bound))
+            self.assertGreaterEqual(count, sum(1 for x in self.values
+                                               if x + x / mitigate.LatencyHistogram._HALF + 1 < bound))
+        self.assertEqual(self.histogram.count_below(mitigate.LatencyHistogram.MAX_VALUE * 2), len(self.values))
+
+    def test_merge(self):
+        merged = mitigate.LatencyHistogram()
+        for half in (self.values[::2], self.values[1::2]):
+            histogram = mitigate.LatencyHistogram()
+            for x in half:
+                histogram.record(x)
+            merged.merge(histogram)
+        self.assertEqual(merged.counts, self.histogram.counts)
+        self.assertEqual((merged.count, merged.sum, merged.max),
+                         (self.histogram.count, self.histogram.sum, self.histogram.max))
+
+    def test_render_prometheus(self):
+        lines = mitigate.StatsRegistry()._render_histogram("x", self.histogram, "")
+        counts = [int(x.rsplit(" ", 1)[1]) for x in lines if x.startswith("x_bucket")]
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual(counts[-1], len(self.values))
+
+
+class StaticResolver(mitigate.DatacenterResolver):
+    """Resolves every region to fixed networks instead of looking up hostnames, counting how often it does."""
+
+    def __init__(self, resolved: typing.Dict[str, typing.List[str]], *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.resolved = resolved
+        self.resolve_calls = 0
+
+    def resolve(self):
+        self.resolve_calls += 1
+        return {region: set(ipaddress.ip_network(x) for x in self.resolved.get(region, ())) for region in self.regions}
+
+
+class TestDatacenterIndex(unittest.TestCase):
+    def test_lookup(self):
+        networks = {
+            "INTL": {ipaddress.ip_network(x) for x in ("10.0.0.0/8", "10.1.2.0/24", "192.168.0.0/16")},
+            "KR": {ipaddress.ip_network(x) for x in ("10.1.0.0/16", "10.1.2.128/25", "172.16.5.7/32")},
+        }
+        index = mitigate.DatacenterIndex(networks)
+        self.assertEqual(index.lookup("10.200.0.1"), "INTL")
+        self.assertEqual(index.lookup("10.1.200.1"), "KR")
+        self.assertEqual(index.lookup("10.1.2.1"), "INTL")
+        self.assertEqual(index.lookup("10.1.2.200"), "KR")
+        self.assertEqual(index.lookup("172.16.5.7"), "KR")
+        self.assertIsNone(index.lookup("172.16.5.8"))
+        self.assertIsNone(index.lookup("11.0.0.1"))
+
+        # Same as the longest matching network, found the slow way.
+        rng = random.Random(9)
+        by_length = sorted(((network, region) for region, x in networks.items() for network in x),
+                           key=lambda x: -x[0].prefixlen)
+        for _ in range(2000):
+            address = ipaddress.ip_address(rng.choice((0x0a000000, 0x0a010000, 0x0a010200, 0xc0a80000, 0xac100500)) |
+                                           rng.randrange(1 << rng.choice((1, 8, 16, 24))))
+            expected = next((region for network, region in by_length if address in network), None)
+            self.assertEqual(index.lookup(str(address)), expected)
+
+    def test_empty(self):
+        index = mitigate.DatacenterIndex({})
+        self.assertFalse(index)
+        self.assertIsNone(index.lookup("10.0.0.1"))
+        self.assertFalse(mitigate.DatacenterIndex({"INTL": set()}))
+
+
+class TestDatacenterResolver(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.directory.name, "datacenters.json")
+        self.config_path = os.path.join(self.directory.name, "config.json")
+        self.previous_index = mitigate.DATACENTER_INDEX
+        self.resolved = {"INTL": ["10.0.1.0/24"], "KR": ["10.0.2.0/24"]}
+
+    def tearDown(self):
+        mitigate.DATACENTER_INDEX = self.previous_index
+        self.directory.cleanup()
+
+    def write_cache(self, networks: typing.Dict[str, typing.List[str]], age: float):
+        with open(self.cache_path, "w") as fp:
+            json.dump(dict(resolved_at=time.time() - age, networks=networks), fp)
+
+    def start(self, **kwargs) -> StaticResolver:
+        resolver = StaticResolver(self.resolved, self.cache_path, **kwargs)
+        resolver.start(background=False)
+        return resolver
+
+    @staticmethod
+    def networks() -> typing.List[str]:
+        return sorted(str(x) for x in mitigate.DATACENTER_INDEX.all_networks())
+
+    def test_no_cache(self):
+        resolver = self.start()
+        self.assertEqual(resolver.resolve_calls, 1)
+        self.assertIsNone(resolver.stale)
+        self.assertEqual(self.networks(), ["10.0.1.0/24", "10.0.2.0/24"])
+        with open(self.cache_path) as fp:
+            self.assertEqual(json.load(fp)["networks"], self.resolved)
+
+    def test_fresh_cache(self):
+        self.write_cache({"INTL": ["10.1.1.0/24"], "KR": ["10.1.2.0/24"]}, 0)
+        resolver = self.start()
+        self.assertEqual(resolver.resolve_calls, 0)
+        self.assertIsNone(resolver.stale)
+        self.assertEqual(self.networks(), ["10.1.1.0/24", "10.1.2.0/24"])
+
+    def test_stale_cache(self):
+        self.write_cache({"INTL": ["10.1.1.0/24"], "KR": ["10.1.2.0/24"]}, mitigate.DATACENTER_CACHE_TTL + 1)
+        resolver = self.start()
+        changes = []
+        resolver.on_change = lambda: changes.append(self.networks())
+        # Used as-is until refreshed, which is left to the caller.
+        self.assertEqual(resolver.resolve_calls, 0)
+        self.assertEqual(self.networks(), ["10.1.1.0/24", "10.1.2.0/24"])
+        resolver.refresh(resolver.stale)
+        self.assertEqual(changes, [["10.0.1.0/24", "10.0.2.0/24"]])
+
+        # Nothing changes when the refresh resolves the same networks again.
+        resolver.refresh({region: set(ipaddress.ip_network(x) for x in networks)
+                          for region, networks in self.resolved.items()})
+        self.assertEqual(len(changes), 1)
+
+    def test_missing_region(self):
+        self.write_cache({"INTL": ["10.1.1.0/24"]}, 0)
+        resolver = self.start()
+        self.assertEqual(resolver.resolve_calls, 0)
+        self.assertEqual(self.networks(), ["10.1.1.0/24"])
+        self.assertIsNotNone(resolver.stale)
+        resolver.refresh(resolver.stale)
+        self.assertEqual(self.networks(), ["10.0.1.0/24", "10.0.2.0/24"])
+
+    def test_config(self):
+        with open(self.config_path, "w") as fp:
+            json.dump({"KR": ["10.2.2.0/24"]}, fp)
+        self.write_cache({"INTL": ["10.1.1.0/24"], "KR": ["10.1.2.0/24"]}, 0)
+        resolver = self.start(config_path=self.config_path)
+        self.assertEqual(resolver.regions, ["INTL"])
+        self.assertEqual(self.networks(), ["10.1.1.0/24", "10.2.2.0/24"])
+
+    def test_config_only(self):
+        with open(self.config_path, "w") as fp:
+            json.dump({"INTL": ["10.2.1.0/24"], "KR": ["10.2.2.0/24"]}, fp)
+        for cache in (None, {"INTL": ["10.1.1.0/24"]}):
+            if cache is not None:
+                self.write_cache(cache, mitigate.DATACENTER_CACHE_TTL + 1)
+            mitigate.DATACENTER_INDEX = mitigate.DatacenterIndex({})
+            resolver = self.start(config_path=self.config_path)
+            self.assertEqual(resolver.resolve_calls, 0)
+            self.assertEqual(self.networks(), ["10.2.1.0/24", "10.2.2.0/24"])
+
+
+class TestPassThrough(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(7)
+        self.traffic = benchmark.TrafficGenerator(self.rng, mitigate.REGION_PROFILES["INTL"], 0.)
+
+    def test_untouched(self):
+        connection = make_connection()
+        # Without a pending request, an ActionEffect is logged but left as it is.
+        for messages in ([self.traffic._unrelated() for _ in range(4)], [self.traffic.action_effect()]):
+            for compressed in (False, True):
+                data = bytearray(benchmark.make_bundle(messages, compressed))
+                original = bytes(data)
+                bundle = connection.destination_to_source(mitigate.XivBundle(data, 0, 0.))
+                self.assertFalse(bundle.dirty)
+                wire = bundle.to_wire()
+                # The original slice itself, not a copy that happens to be equal.
+                self.assertIs(type(wire), memoryview)
+                self.assertIs(wire.obj, data)
+                self.assertEqual(bytes(wire), original)
+
+
+class TestActionEffect(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(8)
+        self.traffic = benchmark.TrafficGenerator(self.rng, mitigate.REGION_PROFILES["INTL"], 0.)
+
+    def exchange(self, connection: mitigate.Connection, compressed: bool, requested_at: float = 100.,
+                 responded_at: float = 100.05) -> typing.Tuple[bytes, bytearray, mitigate.XivBundle]:
+        """Sends an action request, and returns the original, buffer, and processed bundle of the response."""
+        request = bytearray(benchmark.make_bundle([self.traffic.action_request()], compressed))
+        connection.source_to_destination(mitigate.XivBundle(request, 0, requested_at))
+        data = bytearray(benchmark.make_bundle([self.traffic._unrelated(), self.traffic.action_effect()], compressed))
+        original = bytes(data)
+        return original, data, connection.destination_to_source(mitigate.XivBundle(data, 0, responded_at))
+
+    @staticmethod
+    def lock_durations(data: bytes) -> typing.List[float]:
+        res = []
+        for message in mitigate.XivBundle(bytearray(data), 0, 0.).messages:
+            ipc = mitigate.XivMessageIpc(message.data, 0)
+            if ipc.subtype in mitigate.REGION_PROFILES["INTL"].response_action_result:
+                res.append(mitigate.XivMessageIpcActionEffect(ipc.data, 0).animation_lock_duration)
+        return res
+
+    def test_patched_in_place(self):
+        original, data, bundle = self.exchange(make_connection(), False)
+        self.assertTrue(bundle.dirty)
+        wire = bundle.to_wire()
+        # Uncompressed messages are modified where they were received, and nothing gets encoded again.
+        self.assertIs(wire.obj, data)
+        self.assertEqual(len(wire), len(original))
+        # Only the 4 bytes of the lock duration differ.
+        self.assertLessEqual(sum(a != b for a, b in zip(bytes(wire), original)), 4)
+        self.assertNotEqual(self.lock_durations(bytes(wire)), self.lock_durations(original))
+
+    def test_compressed_encoded_again(self):
+        original, data, bundle = self.exchange(make_connection(), True)
+        self.assertTrue(bundle.dirty)
+        wire = bytes(bundle.to_wire())
+        self.assertEqual(mitigate.XivBundle.header_of(wire).length, len(wire))
+        # Decompressed messages are a copy, so the received data is left as it was.
+        self.assertEqual(bytes(data), original)
+        self.assertEqual(len(self.lock_durations(wire)), 1)
+        self.assertNotEqual(self.lock_durations(wire), self.lock_durations(original))
+
+    def test_arrival_time(self):
+        connection = make_connection()
+        original, _, bundle = self.exchange(connection, False, 100., 100.05)
+        # The lock ends EXTRA_DELAY after what the server said, counted from when the request arrived.
+        duration = self.lock_durations(original)[0]
+        expected = 100. + mitigate.EXTRA_DELAY + duration - 100.05
+        self.assertAlmostEqual(self.lock_durations(bytes(bundle.to_wire()))[0], expected, places=5)
+        self.assertAlmostEqual(connection.last_animation_lock_ends_at, 100. + mitigate.EXTRA_DELAY + duration,
+                               places=5)
+        self.assertEqual(connection.stats.action_rtt.count, 1)
+        self.assertAlmostEqual(connection.logged[-1][1]["response_time"], 0.05)
+
+        # Arrival times only come from the bundles, however long processing them took.
+        connection = make_connection()
+        _, _, bundle = self.exchange(connection, False, 100., 200.)
+        self.assertEqual(self.lock_durations(bytes(bundle.to_wire())), [0.])
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(6)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "session.xivcap")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def capture(self, records: typing.List[typing.Tuple[str, bytes, int]]):
+        capture = mitigate.SessionCapture(self.path, ("127.0.0.1", 55006), "INTL")
+        for direction, data, received_at in records:
+            capture.record(direction, memoryview(data), received_at)
+        capture.close()
+
+    def test_round_trip(self):
+        records = [(self.rng.choice(mitigate.SessionCapture.DIRECTIONS), self.rng.randbytes(self.rng.randrange(1000)),
+                    10 ** 18 + i) for i in range(50)]
+        self.capture(records)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        with self.assertRaises(FileExistsError):
+            mitigate.SessionCapture(self.path, ("127.0.0.1", 55006), "INTL")
+
+        # An incomplete last record, as left by a process that got killed while writing it, is skipped.
+        with open(self.path, "ab") as fp:
+            fp.write(mitigate.SessionCapture.RECORD.pack(0, 0, 100) + b"x" * 99)
+        session = mitigate.SessionReplay(self.path)
+        try:
+            self.assertEqual(session.destination, ("127.0.0.1", 55006))
+            self.assertEqual(session.region, "INTL")
+            self.assertEqual([(direction, bytes(data), timestamp) for timestamp, direction, data in session], records)
+        finally:
+            session.close()
+
+    def test_replay(self):
+        data = benchmark.make_stream(self.rng, 2000, 0.5)
+        # Larger than the framer buffer, so it has to be split, and in chunks that do not line up with bundles.
+        self.assertGreater(len(data), mitigate.XivBundleFramer.CAPACITY)
+        self.capture([("D2S", data[:1000], 1), ("D2S", data[1000:], 2), ("S2D", data, 3)])
+        session = mitigate.SessionReplay(self.path)
+        try:
+            connection = mitigate.Connection(None, None, session.destination, session.region,
+                                             log_sink=lambda event, fields: None)
+            self.assertEqual(session.replay(connection), len(data) * 2)
+        finally:
+            session.close()
+        for direction in mitigate.SessionCapture.DIRECTIONS:
+            self.assertEqual(connection.stats.directions[direction].bytes, len(data))
+            self.assertEqual(connection.stats.directions[direction].bundles, 2000)
+
+
+class TestWorkerSupervisor(unittest.TestCase):
+    @unittest.skipUnless(hasattr(os, "fork"), "fork is not supported")
+    def test_log_not_written_again_by_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "log.jsonl")
+            previous = mitigate.log_writer
+            mitigate.log_writer = mitigate.LogWriter(level=mitigate.LOG_ERROR, file_path=path)
+            try:
+                for i in range(2):
+                    mitigate.log_process_event(mitigate.LOG_WARNING, "test", "Record {i}", i=i)
+
+                def run(_: int) -> int:
+                    mitigate.log_writer = mitigate.LogWriter(level=mitigate.LOG_ERROR, file_path=path)
+                    mitigate.log_writer.close()
+                    return 0
+
+                supervisor = mitigate.WorkerSupervisor(2, run)
+                supervisor.start()
+                for pid in list(supervisor.workers):
+                    os.waitpid(pid, 0)
+            finally:
+                mitigate.log_writer.close()
+                mitigate.log_writer = previous
+            with open(path) as fp:
+                self.assertEqual(len(fp.readlines()), 2)
+
+
+class TestSessionAnalysis(unittest.TestCase):
+    def make_analysis(self, rng: random.Random, count: int) -> mitigate.SessionAnalysis:
+        analysis = mitigate.SessionAnalysis()
+        action_ids = [rng.randrange(0x10000) for _ in range(20)]
+        for _ in range(count):
+            event = rng.choice(tuple(mitigate.SessionAnalysis.EVENTS))
+            fields = dict(action_id=rng.choice(action_ids))
+            if event == "action_response":
+                fields.update(original=rng.random(), rewritten=rng.random(),
+                              response_time=None if rng.random() < 0.2 else rng.random())
+            analysis.add(event, fields)
+        return analysis
+
+    @staticmethod
+    def normalize(summaries):
+        return sorted([tuple("nan" if type(x) is float and math.isnan(x) else x for x in y) for y in summaries],
+                      key=lambda x: (x[0] is not None, x[0] or 0))
+
+    def test_summarize(self):
+        analysis = mitigate.SessionAnalysis()
+        for action_id, response_time in ((1, 0.1), (1, 0.3), (2, None)):
+            analysis.add("action_request", dict(action_id=action_id))
+            analysis.add("action_response", dict(action_id=action_id, original=0.6, rewritten=0.5,
+                                                 response_time=response_time))
+        analysis.add("action_request", dict(action_id=3))
+        analysis.add("action_rollback", dict(action_id=3))
+        summaries = analysis.summarize()
+        self.assertEqual([(x.action_id, x.requests, x.responses, x.rollbacks) for x in summaries],
+                         [(None, 4, 3, 1), (1, 2, 2, 0), (2, 1, 1, 0), (3, 1, 0, 1)])
+        self.assertAlmostEqual(summaries[0].response_time_mean, 0.2)
+        self.assertEqual(summaries[0].response_time_p50, 0.1)
+        self.assertEqual(summaries[0].response_time_p99, 0.1)
+        self.assertAlmostEqual(summaries[0].rewritten_lock_mean, 0.5)
+        self.assertTrue(math.isnan(summaries[2].response_time_mean))
+        self.assertTrue(math.isnan(summaries[3].original_lock_mean))
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_numpy_matches_python(self):
+        rng = random.Random(4)
+        for count in (0, 1, 5000):
+            analysis = self.make_analysis(rng, count)
+            for by_action in (False, True):
+                expected = self.normalize(analysis._summarize_python(by_action))
+                actual = self.normalize(analysis._summarize_numpy(numpy, by_action))
+                self.assertEqual(len(actual), len(expected))
+                for a, e in zip(actual, expected):
+                    self.assertEqual(a[0], e[0])
+                    for x, y in zip(a[1:], e[1:]):
+                        if type(x) is float:
+                            self.assertAlmostEqual(x, y, places=9)
+                        else:
+                            self.assertEqual(x, y)
+
+
+if __name__ == "__main__":
+    unittest.main()